@@ -0,0 +1,136 @@
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+import tracemalloc
+import types
+from time import perf_counter
+
+# render offline, kopf.adopt needs a handler context and kopf is not required to build manifests
+kopf = types.ModuleType('kopf')
+kopf.adopt = lambda objs, owner=None: None
+kopf.PermanentError = type('PermanentError', (Exception,), {})
+kopf.engines = types.ModuleType('kopf.engines')
+kopf.engines.logging = logging
+sys.modules.setdefault('kopf', kopf)
+sys.modules.setdefault('kopf.engines', kopf.engines)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from schema import ArgoCronWorkflow, ArgoWebHookEventSource, ArgoWebHookGateway, ArgoWebHookSensor, \
+    ArgoWorkflow, FlowInfo, JobPayload, KubeActionEvent
+
+# etcd rejects requests over 1.5MB by default
+ETCD_LIMIT = int(1.5 * 1024 * 1024)
+WARN_RATIO = 0.8
+
+
+def make_jobs(n_jobs: int, n_steps: int, shape: str) -> dict:
+    jobs = {}
+    for i in range(n_jobs):
+        steps = []
+        for s in range(n_steps):
+            if s % 2:
+                steps.append({'name': f'step {s}', 'uses': 'actions/setup-python@v2',
+                              'with': {'python-version': '3.8'}})
+            else:
+                steps.append({'name': f'step {s}', 'run': f'echo "${{{{ github.sha }}}}" && make target-{s}',
+                              'env': {'STEP': f'{s}'}})
+        job = {'runs-on': 'ubuntu-latest', 'steps': steps}
+        if shape == 'dag' and i:
+            # binary tree of needs
+            job['needs'] = [f'job-{(i - 1) // 2}']
+        jobs[f'job-{i}'] = job
+    return jobs
+
+
+def make_flow_info(name: str, jobs: dict, job_payload: bool) -> FlowInfo:
+    flow_info = FlowInfo.from_metadata(name, {'repository': 'wesky93/KubeAction'})
+    if job_payload:
+        flow_info.jobs_configmap = JobPayload('bench', name, jobs).name
+    return flow_info
+
+
+def render_objects(jobs: dict, n_events: int, job_payload: bool) -> dict:
+    flow_info = make_flow_info('bench', jobs, job_payload)
+    events = {f'hook-{i}': {'port': f'{12000 + i}', 'endpoint': f'/hook-{i}', 'method': 'POST'}
+              for i in range(n_events)}
+    names = list(events)
+    jobs_ref = flow_info.jobs_configmap
+    objects = {
+        'Workflow': lambda: ArgoWorkflow.from_flow('bench', 'bench-x', jobs, flow_info=flow_info).to_dict(),
+        'CronWorkflow': lambda: ArgoCronWorkflow.from_flow('bench', 'bench', '0 * * * *', jobs,
+                                                           flow_info=flow_info).to_dict(),
+        'Event': lambda: KubeActionEvent('bench', 'bench', 'push', {}, jobs=jobs, jobs_ref=jobs_ref).to_dict(),
+        'EventSource': lambda: ArgoWebHookEventSource('bench', 'bench', events).to_dict(),
+        'Gateway': lambda: ArgoWebHookGateway('bench', 'bench', [12000 + i for i in range(n_events)], 9300).to_dict(),
+        'Sensor': lambda: ArgoWebHookSensor('bench', 'bench', event_names=names, sensor_port=9300,
+                                            triggers=[{'template': {'name': 'bench'}}]).to_dict(),
+    }
+    if job_payload:
+        objects['ConfigMap'] = lambda: JobPayload('bench', 'bench', jobs).to_dict()
+    return objects
+
+
+def measure(fn, repeat: int) -> dict:
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            obj = fn()
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {'time_ms': round(best * 1000, 3), 'peak_kb': round(peak / 1024, 1),
+            'size': len(json.dumps(obj, separators=(',', ':')))}
+
+
+def flag(size: int) -> str:
+    if size > ETCD_LIMIT:
+        return 'OVER'
+    if size > ETCD_LIMIT * WARN_RATIO:
+        return 'WARN'
+    return ''
+
+
+def parse_sizes(value: str) -> list:
+    return [int(v) for v in value.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='render time, memory and size of generated manifests')
+    parser.add_argument('--jobs', type=parse_sizes, default=[1, 10, 100, 1000], help='comma separated job counts')
+    parser.add_argument('--steps', type=parse_sizes, default=[1, 10, 100], help='comma separated steps per job')
+    parser.add_argument('--shape', choices=['steps', 'dag'], default='dag')
+    parser.add_argument('--events', type=int, default=10, help='webhook events of the event type')
+    parser.add_argument('--job-payload', action='store_true', help='render with JOB_PAYLOAD_CONFIGMAP')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help='print results as json lines')
+    parser.add_argument('--fail-over', action='store_true', help='exit 1 when an object is over the etcd limit')
+    args = parser.parse_args()
+
+    if args.job_payload:
+        os.environ['JOB_PAYLOAD_CONFIGMAP'] = 'true'
+    over = False
+    if not args.json:
+        print(f"{'jobs':>5} {'steps':>5} {'object':<13} {'time ms':>10} {'peak KB':>10} {'size KB':>10}")
+    for n_jobs in args.jobs:
+        for n_steps in args.steps:
+            jobs = make_jobs(n_jobs, n_steps, args.shape)
+            for kind, fn in render_objects(jobs, args.events, args.job_payload).items():
+                result = measure(fn, args.repeat)
+                mark = flag(result['size'])
+                over = over or mark == 'OVER'
+                if args.json:
+                    print(json.dumps({'jobs': n_jobs, 'steps': n_steps, 'object': kind, 'flag': mark, **result}))
+                else:
+                    print(f"{n_jobs:>5} {n_steps:>5} {kind:<13} {result['time_ms']:>10.2f} "
+                          f"{result['peak_kb']:>10.1f} {result['size'] / 1024:>10.1f} {mark}")
+    if args.fail_over and over:
+        sys.exit(1)
@@ -1,23 +1,499 @@
+import asyncio
+import hashlib
+import json
 import logging
+import os
+import sys
+from collections import deque
+from time import time
 
-from flask import Flask, request
+import kopf
+import kubernetes
+from aiohttp import web
+
+sys.path.append(os.path.dirname(__file__))
+
+from client_helper import ArgoWorkflowAPI, ConfigMapAPI, run_async
+from event_log import EventLog
+from flow_index import FlowIndex, FlowWatcher, parse_data
+from job_queue import JobQueue
+from scheduler import FINISHED_PHASES, ConcurrencyScheduler
+from schema import ArgoWorkflow, FlowInfo, JobPayload, WEBHOOK_ROUTES, get_shared_webhook_namespace, get_uuid
 
 logging.basicConfig(level=logging.DEBUG)
-app = Flask(__name__)
+
+QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '1000'))
+BATCH_SIZE = int(os.environ.get('EVENT_BATCH_SIZE', '50'))
+# seconds to wait for more events before dispatching a partial batch
+BATCH_WAIT = float(os.environ.get('EVENT_BATCH_WAIT', '0.05'))
+# durable event log, events are only kept in memory when not set
+EVENT_LOG_PATH = os.environ.get('EVENT_LOG_PATH')
+# undispatched events in the log before new deliveries are rejected
+MAX_BACKLOG = int(os.environ.get('EVENT_LOG_MAX_BACKLOG', '10000'))
+DISPATCH_RETRY = int(os.environ.get('EVENT_DISPATCH_RETRY', '3'))
+# namespace of watched flows, all namespaces when not set
+WATCH_NAMESPACE = os.environ.get('WATCH_NAMESPACE')
+# seconds between status checks of the running workflow of each concurrency group
+CONCURRENCY_POLL_INTERVAL = float(os.environ.get('CONCURRENCY_POLL_INTERVAL', '5'))
+# seconds a shared webhook routing table is used before it is read again
+ROUTES_TTL = float(os.environ.get('WEBHOOK_ROUTES_TTL', '10'))
+# workflow: an argo workflow per run, warm-pool: jobs are leased by runner-pool pods from /jobs/lease
+EXECUTION_MODE = os.environ.get('EXECUTION_MODE', 'workflow')
+# seconds a leased job is kept without a heartbeat before it is queued again
+JOB_LEASE_TTL = float(os.environ.get('JOB_LEASE_TTL', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '3'))
+# longest long poll of an idle runner
+MAX_LEASE_WAIT = 30
+CONSUMER = 'dispatcher'
+
+
+class LatencyWindow:
+    def __init__(self, size: int = 1000):
+        self.values = deque(maxlen=size)
+
+    def add(self, value: float):
+        self.values.append(value)
+
+    def percentile(self, p: float) -> float:
+        if not self.values:
+            return 0.0
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def to_dict(self) -> dict:
+        return {
+            "p50": round(self.percentile(50) * 1000, 3),
+            "p99": round(self.percentile(99) * 1000, 3),
+        }
+
+
+class EventIngestor:
+    # events are acknowledged once queued(or written to the event log), a single worker dispatches them in batches
+    def __init__(self, dispatch, log: EventLog = None, queue_size: int = QUEUE_SIZE, batch_size: int = BATCH_SIZE,
+                 batch_wait: float = BATCH_WAIT, max_backlog: int = MAX_BACKLOG):
+        self.dispatch = dispatch
+        self.log = log
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_backlog = max_backlog
+        self.checkpoint = log.checkpoint(CONSUMER) if log else 0
+        self.wakeup = asyncio.Event()
+        self.ack_latency = LatencyWindow()
+        self.queue_latency = LatencyWindow()
+        self.accepted = 0
+        self.duplicated = 0
+        self.rejected = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.dead_lettered = 0
+
+    @property
+    def backlog(self) -> int:
+        if self.log:
+            return self.log.last_id - self.checkpoint
+        return self.queue.qsize()
+
+    def submit(self, event: dict, received: float) -> bool:
+        try:
+            self.queue.put_nowait((received, event, None))
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def ingest(self, key: str, event: dict, received: float) -> bool:
+        if not self.log:
+            return self.submit(event, received)
+        if self.backlog >= self.max_backlog:
+            self.rejected += 1
+            return False
+        _, duplicated = await asyncio.wrap_future(self.log.append(key, event, received))
+        if duplicated:
+            self.duplicated += 1
+        else:
+            self.accepted += 1
+            self.wakeup.set()
+        return True
+
+    async def tail(self):
+        # feed events after the checkpoint from the log into the dispatch queue
+        loop = asyncio.get_event_loop()
+        cursor = self.checkpoint
+        while True:
+            self.wakeup.clear()
+            rows = await loop.run_in_executor(None, self.log.read, cursor, self.batch_size)
+            if not rows:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), 1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for event_id, received, event in rows:
+                await self.queue.put((received, event, event_id))
+                cursor = event_id
+
+    async def next_batch(self) -> list:
+        loop = asyncio.get_event_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.batch_wait
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def dispatch_one(self, event: dict, event_id: int = None):
+        # retried alone, flows already started for this event are not started again
+        done = set()
+        error = None
+        for retry in range(DISPATCH_RETRY):
+            try:
+                await self.dispatch(event, done)
+                self.dispatched += 1
+                return
+            except Exception as e:
+                error = e
+                logging.exception(f'fail to dispatch event {event_id} ({retry + 1}/{DISPATCH_RETRY})')
+                if retry + 1 < DISPATCH_RETRY:
+                    await asyncio.sleep(2 ** retry)
+        self.failed += 1
+        if self.log:
+            # raises when the dead letter can not be written, the consumer stops before the checkpoint moves
+            await asyncio.get_event_loop().run_in_executor(None, self.log.dead_letter, event_id, repr(error))
+            self.dead_lettered += 1
+        else:
+            logging.error(f'drop event {event.get("event_type_name")}, no event log for dead letters')
+
+    async def dispatch_batch(self, batch: list):
+        for _, event, event_id in batch:
+            await self.dispatch_one(event, event_id)
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        if self.log:
+            asyncio.ensure_future(self.tail())
+        try:
+            await self._consume(loop)
+        except Exception:
+            logging.exception('event consumer stopped, undispatched events stay after the checkpoint')
+            raise
+
+    async def _consume(self, loop):
+        while True:
+            batch = await self.next_batch()
+            now = time()
+            for received, _, _ in batch:
+                self.queue_latency.add(now - received)
+            await self.dispatch_batch(batch)
+            if self.log:
+                # at least once, every event of the batch was dispatched or written as a dead letter
+                self.checkpoint = batch[-1][2]
+                await loop.run_in_executor(None, self.log.set_checkpoint, CONSUMER, self.checkpoint)
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "queue_size": self.queue.maxsize,
+            "backlog": self.backlog,
+            "accepted": self.accepted,
+            "duplicated": self.duplicated,
+            "rejected": self.rejected,
+            "dispatched": self.dispatched,
+            "failed": self.failed,
+            "dead_lettered": self.dead_lettered,
+            "log_commits": self.log.commits if self.log else 0,
+            "ack_latency_ms": self.ack_latency.to_dict(),
+            "queue_latency_ms": self.queue_latency.to_dict(),
+        }
+
+
+class TimingStats:
+    # per flow average of the job timing summaries posted by job.py
+    def __init__(self):
+        self.flows = {}
+
+    def add(self, summary: dict):
+        flow = self.flows.setdefault(summary.get('flow') or '', {"jobs": 0, "total": 0.0, "phases": {}})
+        flow['jobs'] += 1
+        flow['total'] += summary.get('total', 0)
+        for phase, duration in summary.get('phases', {}).items():
+            flow['phases'][phase] = flow['phases'].get(phase, 0) + duration
+
+    def to_dict(self) -> dict:
+        return {
+            name: {
+                "jobs": flow['jobs'],
+                "avg_total": round(flow['total'] / flow['jobs'], 3),
+                "avg_phases": {k: round(v / flow['jobs'], 3) for k, v in flow['phases'].items()},
+            }
+            for name, flow in self.flows.items()
+        }
+
+
+timing_stats = TimingStats()
+flow_index = FlowIndex()
+
+
+created_payloads = set()
+
+
+async def ensure_payload(flow: dict, jobs: dict) -> str:
+    # usually created by the controller already, only the first run of a content hash calls the api
+    meta = flow['metadata']
+    payload = JobPayload(meta['namespace'], meta['name'], jobs)
+    if payload.name not in created_payloads:
+        body = payload.to_dict()
+        kopf.append_owner_reference(body, owner=flow)
+        await run_async(ConfigMapAPI(meta['namespace']).create, body=body)
+        created_payloads.add(payload.name)
+    return payload.name
+
+
+async def run_flow(flow: dict, event: dict, labels: dict = None) -> str:
+    meta = flow['metadata']
+    spec = flow.get('spec', {})
+    flow_info = FlowInfo.from_metadata(meta['name'], spec.get('metadata', {}))
+    if JobPayload.enabled():
+        flow_info.jobs_configmap = await ensure_payload(flow, spec.get('jobs', {}))
+    wf = ArgoWorkflow.from_flow(meta['namespace'], f"{meta['name']}-{get_uuid()}", spec.get('jobs', {}),
+                                flow_info=flow_info)
+    body = wf.to_dict(adopt=False)
+    body['metadata'].setdefault('labels', {}).update(labels or {})
+    kopf.append_owner_reference(body, owner=flow)
+    wf = await ArgoWorkflowAPI(meta['namespace']).to_async().create(body=body)
+    return wf['metadata']['name']
+
+
+async def cancel_workflow(namespace: str, name: str):
+    # same as `argo terminate`, exit handlers are skipped
+    await ArgoWorkflowAPI(namespace).to_async().patch(name=name, body={"spec": {"activeDeadlineSeconds": 0}})
+
+
+async def get_workflow_phase(namespace: str, name: str):
+    try:
+        wf = await ArgoWorkflowAPI(namespace).to_async().get(name=name)
+    except kubernetes.client.rest.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+    return wf.get('status', {}).get('phase') or 'Pending'
+
+
+async def find_running_workflow(namespace: str, labels: dict):
+    selector = ','.join(f'{k}={v}' for k, v in labels.items())
+    workflows = (await ArgoWorkflowAPI(namespace).to_async().list(label_selector=selector)).get('items', [])
+    running = [wf for wf in workflows if wf.get('status', {}).get('phase') not in FINISHED_PHASES]
+    running.sort(key=lambda wf: wf['metadata'].get('creationTimestamp', ''))
+    return running[-1]['metadata']['name'] if running else None
+
+
+job_queue = JobQueue(lease_ttl=JOB_LEASE_TTL, max_attempts=JOB_MAX_ATTEMPTS)
+
+
+async def queue_flow(flow: dict, event: dict, labels: dict = None) -> str:
+    meta = flow['metadata']
+    spec = flow.get('spec', {})
+    flow_info = FlowInfo.from_metadata(meta['name'], spec.get('metadata', {}))
+    secrets = (flow_info.secrets or {}).get('name')
+    return job_queue.submit(meta['namespace'], meta['name'], flow_info.repo, secrets, spec.get('jobs', {}),
+                            labels=labels)
+
+
+async def cancel_queued_run(namespace: str, name: str):
+    job_queue.cancel(name)
+
+
+async def get_queued_run_phase(namespace: str, name: str):
+    return job_queue.phase(name)
+
+
+async def find_queued_run(namespace: str, labels: dict):
+    return job_queue.find_running(namespace, labels)
+
+
+if EXECUTION_MODE == 'warm-pool':
+    scheduler = ConcurrencyScheduler(queue_flow, cancel_queued_run, get_queued_run_phase, find_queued_run,
+                                     poll_interval=CONCURRENCY_POLL_INTERVAL)
+else:
+    scheduler = ConcurrencyScheduler(run_flow, cancel_workflow, get_workflow_phase, find_running_workflow,
+                                     poll_interval=CONCURRENCY_POLL_INTERVAL)
+
+
+async def dispatch_event(event: dict, done: set):
+    # done: flows already submitted by an earlier try of this event
+    event_type_name = event.get('event_type_name')
+    if event_type_name == 'kubeaction_timing':
+        timing_stats.add(event.get('data') or {})
+        return
+    flows = flow_index.lookup(event_type_name, event)
+    logging.info(f"event {event_type_name} matched {len(flows)} flows")
+    data = parse_data(event)
+    for flow in flows:
+        key = f"{flow['metadata']['namespace']}/{flow['metadata']['name']}"
+        if key in done:
+            continue
+        await scheduler.submit(flow, event, data)
+        done.add(key)
+
+
+class WebhookRoutes:
+    # routing table of the shared webhook gateway, route key -> event_type_name
+    def __init__(self, namespace: str, ttl: float = ROUTES_TTL):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.routes = {}
+        self.loaded = 0
+
+    async def load(self):
+        try:
+            data = await run_async(ConfigMapAPI(self.namespace).read_data, name=WEBHOOK_ROUTES)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            data = {}
+        self.routes = {k: json.loads(v) for k, v in data.items()}
+        self.loaded = time()
+
+    async def lookup(self, key: str):
+        # a new route is picked up on its first event, unknown keys re-read at most once a second
+        age = time() - self.loaded
+        if age > self.ttl or (key not in self.routes and age > 1):
+            await self.load()
+        return self.routes.get(key)
+
+
+webhook_routes = WebhookRoutes(get_shared_webhook_namespace())
+
+
+def get_idempotency_key(request: web.Request, raw: bytes) -> str:
+    return request.headers.get('X-Idempotency-Key') \
+           or request.headers.get('X-GitHub-Delivery') \
+           or hashlib.sha256(raw).hexdigest()
+
+
+async def post_events(request: web.Request):
+    received = time()
+    raw = await request.read()
+    try:
+        event = await request.json()
+    except ValueError:
+        return web.json_response({"error": "body must be json"}, status=400)
+    ingestor: EventIngestor = request.app['ingestor']
+    if not await ingestor.ingest(get_idempotency_key(request, raw), event, received):
+        return web.json_response({"error": "event queue is full"}, status=429, headers={"Retry-After": "1"})
+    ingestor.ack_latency.add(time() - received)
+    return web.json_response({"accepted": True}, status=202)
+
+
+async def post_gateway_events(request: web.Request):
+    # cloud events of the shared webhook gateway, binary(ce-* headers) or structured mode
+    received = time()
+    raw = await request.read()
+    try:
+        body = json.loads(raw) if raw else None
+    except ValueError:
+        return web.json_response({"error": "body must be json"}, status=400)
+    if 'ce-subject' in request.headers:
+        context = {k[3:].lower(): v for k, v in request.headers.items() if k.lower().startswith('ce-')}
+        data = body
+    else:
+        context = {k: v for k, v in (body or {}).items() if k != 'data'}
+        data = (body or {}).get('data')
+    route = await webhook_routes.lookup(context.get('subject', ''))
+    if not route:
+        return web.json_response({"error": f"no route for {context.get('subject')}"}, status=404)
+    event = {"event_type_name": route['event_type_name'], "context": context, "data": data}
+    key = context.get('id') or hashlib.sha256(raw).hexdigest()
+    ingestor: EventIngestor = request.app['ingestor']
+    if not await ingestor.ingest(key, event, received):
+        return web.json_response({"error": "event queue is full"}, status=429, headers={"Retry-After": "1"})
+    ingestor.ack_latency.add(time() - received)
+    return web.json_response({"accepted": True}, status=202)
+
+
+async def post_job_lease(request: web.Request):
+    # {"worker": <pod name>, "secrets": <mounted secret name>, "wait": <seconds>}
+    body = await request.json()
+    if not body.get('worker'):
+        return web.json_response({"error": "worker must be set"}, status=400)
+    try:
+        wait = float(body.get('wait') or 0)
+    except (TypeError, ValueError):
+        wait = None
+    if wait is None or not wait >= 0:
+        return web.json_response({"error": "wait must be a number of seconds"}, status=400)
+    wait = min(wait, MAX_LEASE_WAIT)
+    assignment = await job_queue.wait_lease(body['worker'], body.get('secrets'), wait)
+    if not assignment:
+        return web.Response(status=204)
+    return web.json_response(assignment)
+
+
+async def post_job_heartbeat(request: web.Request):
+    body = await request.json()
+    if not job_queue.heartbeat(request.match_info['task_id'], body.get('worker')):
+        # lease expired or the run was cancelled
+        return web.json_response({"error": "lease lost"}, status=409)
+    return web.json_response({"lease_ttl": job_queue.lease_ttl})
+
+
+async def post_job_complete(request: web.Request):
+    # {"worker": <pod name>, "status": "succeeded" | "failed", "timing": <timer summary>}
+    body = await request.json()
+    timing = body.get('timing')
+    if not job_queue.complete(request.match_info['task_id'], body.get('worker'), body.get('status') == 'succeeded',
+                              timing):
+        return web.json_response({"error": "lease lost"}, status=409)
+    if timing:
+        timing_stats.add(timing)
+    return web.json_response({"accepted": True})
+
+
+async def get_metrics(request: web.Request):
+    return web.json_response({
+        **request.app['ingestor'].metrics(),
+        "flows_indexed": len(flow_index),
+        "webhook_routes": len(webhook_routes.routes),
+        "concurrency": scheduler.metrics(),
+        "job_queue": job_queue.metrics(),
+        "timing": timing_stats.to_dict(),
+    })
+
+
+async def start_ingestor(app: web.Application):
+    if os.environ.get('FLOW_INDEX', 'true') == 'true':
+        FlowWatcher(flow_index, WATCH_NAMESPACE).start()
+    log = EventLog(EVENT_LOG_PATH) if EVENT_LOG_PATH else None
+    app['ingestor'] = EventIngestor(dispatch_event, log=log)
+    app['ingestor_task'] = asyncio.ensure_future(app['ingestor'].run())
+    app['scheduler_task'] = asyncio.ensure_future(scheduler.poll())
 
 
-@app.route("/events", methods=['POST'])
-def hello():
-    logging.info(f"{request}")
-    logging.info(f"data {request.json}")
-    logging.info(f"{request.headers}")
-    logging.info(f"{request.endpoint}")
+async def stop_ingestor(app: web.Application):
+    app['ingestor_task'].cancel()
+    app['scheduler_task'].cancel()
+    if app['ingestor'].log:
+        app['ingestor'].log.close()
 
-    print(request)
 
-    return "Hello from Python!"
+def make_app() -> web.Application:
+    app = web.Application()
+    app.router.add_post('/events', post_events)
+    app.router.add_post('/gateway', post_gateway_events)
+    app.router.add_post('/jobs/lease', post_job_lease)
+    app.router.add_post('/jobs/{task_id}/heartbeat', post_job_heartbeat)
+    app.router.add_post('/jobs/{task_id}/complete', post_job_complete)
+    app.router.add_get('/metrics', get_metrics)
+    app.on_startup.append(start_ingestor)
+    app.on_cleanup.append(stop_ingestor)
+    return app
 
 
 if __name__ == "__main__":
-    app.config['LOGGING_LEVEL'] = logging.DEBUG
-    app.run(host='0.0.0.0')
+    web.run_app(make_app(), host='0.0.0.0', port=int(os.environ.get('API_PORT', '5000')))
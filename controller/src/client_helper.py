@@ -1,8 +1,63 @@
+import asyncio
+import base64
+import copy
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 
 import kubernetes
 
+SPEC_HASH_ANNOTATION = 'kubeaction.spaceone.dev/spec-hash'
+# children rendered for an owner, objects no longer rendered are deleted by this label
+OWNER_LABEL = 'kubeaction.spaceone.dev/owner'
+
+# connections kept open to the api server, match it to the number of handler threads
+POOL_SIZE = int(os.environ.get('KUBE_CONNECTION_POOL_SIZE', '32'))
+
+_api_client = None
+_executor = None
+_lock = threading.Lock()
+
+
+def get_configuration() -> kubernetes.client.Configuration:
+    if not os.environ.get('KUBECTL_CONFIG_MODE', True) == 'false':
+        kubernetes.config.load_kube_config()
+    else:
+        kubernetes.config.load_incluster_config()
+    # a copy of the default configuration set by load_*_config
+    conf = kubernetes.client.Configuration()
+    proxy = os.environ.get('KUBE_PROXY')
+    if proxy:
+        conf.proxy = proxy
+    conf.connection_pool_maxsize = POOL_SIZE
+    return conf
+
+
+def get_api_client() -> kubernetes.client.ApiClient:
+    # one client(and connection pool) per process, config is loaded once
+    global _api_client
+    with _lock:
+        if _api_client is None:
+            conf = get_configuration()
+            kubernetes.client.Configuration.set_default(conf)
+            _api_client = kubernetes.client.ApiClient(conf)
+        return _api_client
+
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix='kube-api')
+        return _executor
+
+
+async def run_async(fn, **kwargs):
+    # blocking client call on a pool no larger than the connection pool
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), partial(fn, **kwargs))
+
 
 class CustomObjectApi:
     group = ""
@@ -10,15 +65,7 @@ class CustomObjectApi:
     plural = ""
 
     def __init__(self, namespace=None):
-        if not os.environ.get('KUBECTL_CONFIG_MODE', True) == 'false':
-            kubernetes.config.load_kube_config()
-        else:
-            kubernetes.config.load_incluster_config()
-            proxy = os.environ.get('KUBE_PROXY')
-            if proxy:
-                conf = kubernetes.client.Configuration()
-                conf.proxy = proxy
-        self.api = kubernetes.client.CustomObjectsApi()
+        self.api = kubernetes.client.CustomObjectsApi(get_api_client())
         self.namespace = namespace
 
     def get_client(self, method, postfix=""):
@@ -43,9 +90,115 @@ class CustomObjectApi:
     def delete(self, **kwargs):
         return self.get_client('delete')(**kwargs)
 
+    def patch(self, **kwargs):
+        return self.get_client('patch')(**kwargs)
+
+    def replace(self, **kwargs):
+        return self.get_client('replace')(**kwargs)
+
     def list(self, **kwargs):
         return self.get_client('list')(**kwargs)
 
+    def apply(self, body: dict):
+        # create, or replace when the rendered spec hash differs. returns (object, action)
+        meta = body['metadata']
+        try:
+            current = self.get(name=meta['name'])
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            return self.create(body=body), 'created'
+        current_meta = current.get('metadata', {})
+        desired_hash = meta.get('annotations', {}).get(SPEC_HASH_ANNOTATION)
+        if desired_hash and current_meta.get('annotations', {}).get(SPEC_HASH_ANNOTATION) == desired_hash \
+                and all(current_meta.get('labels', {}).get(k) == v for k, v in meta.get('labels', {}).items()):
+            return current, 'unchanged'
+        # only spec, our labels/annotations and owner are replaced. status(no status subresource), finalizers and
+        # fields of other controllers are kept, current resourceVersion makes a concurrent write fail with 409
+        merged = copy.deepcopy(current)
+        merged['spec'] = body['spec']
+        merged_meta = merged['metadata']
+        merged_meta['labels'] = {**current_meta.get('labels', {}), **meta.get('labels', {})}
+        merged_meta['annotations'] = {**current_meta.get('annotations', {}), **meta.get('annotations', {})}
+        if meta.get('ownerReferences'):
+            merged_meta['ownerReferences'] = meta['ownerReferences']
+        return self.replace(name=meta['name'], body=merged), 'replaced'
+
+    def prune(self, owner: str, keep: set) -> list:
+        # delete children of owner which are not in keep
+        deleted = []
+        for obj in self.list(label_selector=f'{OWNER_LABEL}={owner}').get('items', []):
+            name = obj['metadata']['name']
+            if name not in keep:
+                self.delete(name=name, body={})
+                deleted.append(name)
+        return deleted
+
+    def to_async(self) -> 'AsyncCustomObjectApi':
+        return AsyncCustomObjectApi(self)
+
+
+class AsyncCustomObjectApi:
+    # same calls for async handlers
+    def __init__(self, api: CustomObjectApi):
+        self.api = api
+
+    async def _run(self, method, **kwargs):
+        return await run_async(getattr(self.api, method), **kwargs)
+
+    async def create(self, **kwargs):
+        return await self._run('create', **kwargs)
+
+    async def get(self, **kwargs):
+        return await self._run('get', **kwargs)
+
+    async def delete(self, **kwargs):
+        return await self._run('delete', **kwargs)
+
+    async def patch(self, **kwargs):
+        return await self._run('patch', **kwargs)
+
+    async def list(self, **kwargs):
+        return await self._run('list', **kwargs)
+
+    async def apply(self, body: dict):
+        return await self._run('apply', body=body)
+
+    async def prune(self, owner: str, keep: set) -> list:
+        return await self._run('prune', owner=owner, keep=keep)
+
+
+class ConfigMapAPI:
+    def __init__(self, namespace):
+        self.api = kubernetes.client.CoreV1Api(get_api_client())
+        self.namespace = namespace
+
+    def create(self, body: dict) -> bool:
+        # for content addressed maps, an existing one already holds the same data
+        try:
+            self.api.create_namespaced_config_map(self.namespace, body)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        return True
+
+    def patch_data(self, name: str, data: dict):
+        # merge patch, keys set to None are removed. creates the map when it does not exist
+        try:
+            return self.api.patch_namespaced_config_map(name, self.namespace, {"data": data})
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+        body = {"metadata": {"name": name}, "data": {k: v for k, v in data.items() if v is not None}}
+        return self.api.create_namespaced_config_map(self.namespace, body)
+
+    def read_data(self, name: str) -> dict:
+        cm = self.api.read_namespaced_config_map(name, self.namespace)
+        data = dict(cm.data or {})
+        data.update({k: base64.b64decode(v) for k, v in (cm.binary_data or {}).items()})
+        return data
+
 
 class ArgoAPI(CustomObjectApi):
     group = 'argoproj.io'
@@ -0,0 +1,211 @@
+import argparse
+import json
+import sqlite3
+import threading
+from concurrent.futures import Future
+from datetime import datetime
+from time import time
+
+import shortuuid
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    received REAL NOT NULL,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_received ON events (received);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    consumer TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    event_id INTEGER PRIMARY KEY,
+    failed REAL NOT NULL,
+    error TEXT NOT NULL
+);
+"""
+
+
+def connect(path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute('PRAGMA journal_mode=WAL')
+    # fsync on every commit, group commit keeps the number of commits low
+    conn.execute('PRAGMA synchronous=FULL')
+    conn.executescript(SCHEMA)
+    return conn
+
+
+class EventLog:
+    # append only webhook delivery log on sqlite WAL, appends from many requests share one commit
+    def __init__(self, path: str, commit_interval: float = 0.005, max_batch: int = 500):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self.commits = 0
+        self._write_conn = connect(path)
+        self._read_conn = connect(path)
+        self._read_lock = threading.Lock()
+        self._pending = []
+        self._cond = threading.Condition()
+        self._closed = False
+        self.last_id = self._read_conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def append(self, key: str, body: dict, received: float = None) -> Future:
+        # resolves to (id, duplicated) once the event is durable
+        fut = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError('event log is closed')
+            self._pending.append((key, received or time(), json.dumps(body), fut))
+            self._cond.notify()
+        return fut
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+                if len(self._pending) < self.max_batch and not self._closed:
+                    # let concurrent requests join this commit
+                    self._cond.wait(self.commit_interval)
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+            self._commit(batch)
+
+    def _commit(self, batch: list):
+        results = []
+        try:
+            conn = self._write_conn
+            conn.execute('BEGIN')
+            for key, received, body, _ in batch:
+                cur = conn.execute('INSERT OR IGNORE INTO events (key, received, body) VALUES (?, ?, ?)',
+                                   (key, received, body))
+                if cur.rowcount:
+                    results.append((cur.lastrowid, False))
+                else:
+                    row = conn.execute('SELECT id FROM events WHERE key = ?', (key,)).fetchone()
+                    results.append((row[0], True))
+            conn.execute('COMMIT')
+            self.commits += 1
+        except Exception as e:
+            self._write_conn.execute('ROLLBACK')
+            for *_, fut in batch:
+                fut.set_exception(e)
+            return
+        for (event_id, duplicated), (*_, fut) in zip(results, batch):
+            self.last_id = max(self.last_id, event_id)
+            fut.set_result((event_id, duplicated))
+
+    def read(self, after_id: int, limit: int = 100) -> list:
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT id, received, body FROM events WHERE id > ? ORDER BY id LIMIT ?', (after_id, limit)
+            ).fetchall()
+        return [(event_id, received, json.loads(body)) for event_id, received, body in rows]
+
+    def checkpoint(self, consumer: str) -> int:
+        with self._read_lock:
+            row = self._read_conn.execute('SELECT last_id FROM checkpoints WHERE consumer = ?',
+                                          (consumer,)).fetchone()
+        return row[0] if row else 0
+
+    def set_checkpoint(self, consumer: str, last_id: int):
+        with self._read_lock:
+            self._read_conn.execute(
+                'INSERT INTO checkpoints (consumer, last_id) VALUES (?, ?) '
+                'ON CONFLICT(consumer) DO UPDATE SET last_id = excluded.last_id', (consumer, last_id))
+
+    def dead_letter(self, event_id: int, error: str):
+        # events that kept failing, kept out of prune until retried
+        with self._read_lock:
+            self._read_conn.execute('INSERT OR REPLACE INTO dead_letters (event_id, failed, error) VALUES (?, ?, ?)',
+                                    (event_id, time(), error))
+
+    def dead_letters(self) -> list:
+        with self._read_lock:
+            return self._read_conn.execute(
+                'SELECT d.event_id, d.failed, d.error, e.key FROM dead_letters d JOIN events e ON e.id = d.event_id '
+                'ORDER BY d.event_id').fetchall()
+
+    def retry_dead_letters(self) -> int:
+        # re-append dead letters as new events, like replay
+        prefix = f'retry:{shortuuid.uuid()}'
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT e.id, e.key, e.body FROM dead_letters d JOIN events e ON e.id = d.event_id ORDER BY e.id'
+            ).fetchall()
+        futures = [self.append(f'{prefix}:{key}', json.loads(body)) for _, key, body in rows]
+        for fut in futures:
+            fut.result()
+        with self._read_lock:
+            self._read_conn.executemany('DELETE FROM dead_letters WHERE event_id = ?', [(r[0],) for r in rows])
+        return len(futures)
+
+    def replay(self, since: float, until: float) -> int:
+        # re-append deliveries in the time range, consumers pick them up as new events
+        prefix = f'replay:{shortuuid.uuid()}'
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                'SELECT key, body FROM events WHERE received >= ? AND received < ? ORDER BY id', (since, until)
+            ).fetchall()
+        futures = [self.append(f'{prefix}:{key}', json.loads(body)) for key, body in rows]
+        for fut in futures:
+            fut.result()
+        return len(futures)
+
+    def prune(self, before: float, consumer: str) -> int:
+        # drop consumed events older than before
+        last_id = self.checkpoint(consumer)
+        with self._read_lock:
+            cur = self._read_conn.execute(
+                'DELETE FROM events WHERE received < ? AND id <= ? AND id NOT IN (SELECT event_id FROM dead_letters)',
+                (before, last_id))
+        return cur.rowcount
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._writer.join()
+
+
+def parse_time(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='kubeaction webhook event log')
+    parser.add_argument('--path', default='events.db')
+    sub = parser.add_subparsers(dest='command', required=True)
+    replay = sub.add_parser('replay', help='re-drive deliveries received in a time range')
+    replay.add_argument('--since', required=True, help='ISO time, e.g. 2020-07-01T10:00:00')
+    replay.add_argument('--until', default=None, help='ISO time, default now')
+    prune = sub.add_parser('prune', help='delete consumed deliveries older than days')
+    prune.add_argument('--days', type=float, required=True)
+    prune.add_argument('--consumer', default='dispatcher')
+    sub.add_parser('stats')
+    sub.add_parser('dead-letters', help='list events that failed to dispatch')
+    sub.add_parser('retry-dead-letters', help='re-drive events that failed to dispatch')
+    args = parser.parse_args()
+
+    log = EventLog(args.path)
+    if args.command == 'replay':
+        until = parse_time(args.until) if args.until else time()
+        print(f'replayed {log.replay(parse_time(args.since), until)} events')
+    elif args.command == 'prune':
+        print(f'pruned {log.prune(time() - args.days * 86400, args.consumer)} events')
+    elif args.command == 'dead-letters':
+        for event_id, failed, error, key in log.dead_letters():
+            print(event_id, datetime.fromtimestamp(failed).isoformat(), key, error)
+    elif args.command == 'retry-dead-letters':
+        print(f'retried {log.retry_dead_letters()} events')
+    else:
+        print({'last_id': log.last_id, 'dispatcher': log.checkpoint('dispatcher'),
+               'dead_letters': len(log.dead_letters())})
+    log.close()
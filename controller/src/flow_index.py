@@ -0,0 +1,183 @@
+import json
+import logging
+import re
+import threading
+from functools import lru_cache
+from time import sleep
+
+import kubernetes
+
+try:
+    from client_helper import KubeActionFlowAPI
+except Exception:
+    from .client_helper import KubeActionFlowAPI
+
+# spec.events keys which are not delivered through /events
+NON_WEBHOOK_EVENTS = ('schedule',)
+
+
+@lru_cache(maxsize=1024)
+def glob_to_regex(pattern: str):
+    # github filter pattern, ** matches across / and * does not
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(f'^{regex}$')
+
+
+def match_any(patterns: list, value: str) -> bool:
+    return any(glob_to_regex(p).match(value) for p in patterns)
+
+
+def parse_data(event: dict) -> dict:
+    data = event.get('data') or {}
+    if isinstance(data, str):
+        try:
+            data = json.loads(data)
+        except ValueError:
+            return {}
+    return data if isinstance(data, dict) else {}
+
+
+def changed_paths(data: dict) -> set:
+    paths = set()
+    for commit in data.get('commits') or []:
+        for k in ('added', 'modified', 'removed'):
+            paths.update(commit.get(k) or [])
+    return paths
+
+
+class Subscription:
+    def __init__(self, flow: dict, config: dict):
+        self.flow = flow
+        config = config or {}
+        self.branches = config.get('branches')
+        self.branches_ignore = config.get('branches-ignore')
+        self.tags = config.get('tags')
+        self.paths = config.get('paths')
+        self.paths_ignore = config.get('paths-ignore')
+
+    def match(self, event: dict) -> bool:
+        data = parse_data(event)
+        ref = data.get('ref') or ''
+        if ref.startswith('refs/tags/'):
+            # with only branch filters, tags do not trigger and the other way around
+            if self.tags is None:
+                if self.branches is not None or self.branches_ignore:
+                    return False
+            elif not match_any(self.tags, ref[len('refs/tags/'):]):
+                return False
+        else:
+            branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else ref
+            if self.branches is None and not self.branches_ignore:
+                if self.tags is not None and ref:
+                    return False
+            elif self.branches is not None and not match_any(self.branches, branch):
+                return False
+            elif self.branches_ignore and match_any(self.branches_ignore, branch):
+                return False
+        if self.paths is not None or self.paths_ignore:
+            paths = changed_paths(data)
+            if self.paths is not None and not any(match_any(self.paths, p) for p in paths):
+                return False
+            if self.paths_ignore and paths and all(match_any(self.paths_ignore, p) for p in paths):
+                return False
+        return True
+
+
+def flow_key(flow: dict) -> tuple:
+    meta = flow.get('metadata', {})
+    return meta.get('namespace'), meta.get('name')
+
+
+class FlowIndex:
+    # event_type_name -> subscribed flows, updated from the flows watch so dispatch needs no api call
+    def __init__(self):
+        self._by_type = {}
+        self._types_of = {}
+        self._lock = threading.Lock()
+
+    def update(self, flow: dict):
+        key = flow_key(flow)
+        events = (flow.get('spec') or {}).get('events') or {}
+        with self._lock:
+            self._remove(key)
+            types = []
+            for event_type_name, config in events.items():
+                if event_type_name in NON_WEBHOOK_EVENTS:
+                    continue
+                self._by_type.setdefault(event_type_name, {})[key] = Subscription(flow, config)
+                types.append(event_type_name)
+            self._types_of[key] = types
+
+    def remove(self, flow: dict):
+        with self._lock:
+            self._remove(flow_key(flow))
+
+    def _remove(self, key: tuple):
+        for event_type_name in self._types_of.pop(key, []):
+            subs = self._by_type.get(event_type_name, {})
+            subs.pop(key, None)
+            if not subs:
+                self._by_type.pop(event_type_name, None)
+
+    def replace(self, flows: list):
+        with self._lock:
+            self._by_type = {}
+            self._types_of = {}
+        for flow in flows:
+            self.update(flow)
+
+    def lookup(self, event_type_name: str, event: dict) -> list:
+        with self._lock:
+            subs = list(self._by_type.get(event_type_name, {}).values())
+        return [s.flow for s in subs if s.match(event)]
+
+    def __len__(self):
+        return len(self._types_of)
+
+
+class FlowWatcher(threading.Thread):
+    # informer style list + watch of flows, relists when the watch expires
+    def __init__(self, index: FlowIndex, namespace: str = None):
+        super().__init__(daemon=True)
+        self.index = index
+        self.namespace = namespace
+
+    def run(self):
+        while True:
+            try:
+                self.watch(KubeActionFlowAPI(self.namespace))
+            except Exception:
+                logging.exception('flow watch failed, relist after 5 seconds')
+                sleep(5)
+
+    def watch(self, api: KubeActionFlowAPI):
+        flows = api.list()
+        self.index.replace(flows.get('items', []))
+        version = flows.get('metadata', {}).get('resourceVersion')
+        logging.info(f'flow index loaded {len(self.index)} flows')
+        while True:
+            w = kubernetes.watch.Watch()
+            for event in w.stream(api.get_client('list'), resource_version=version, timeout_seconds=300):
+                obj = event['object']
+                if event['type'] == 'ERROR':
+                    # 410 gone, resource version is too old
+                    return
+                version = obj.get('metadata', {}).get('resourceVersion', version)
+                if event['type'] in ('ADDED', 'MODIFIED'):
+                    self.index.update(obj)
+                elif event['type'] == 'DELETED':
+                    self.index.remove(obj)
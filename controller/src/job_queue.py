@@ -0,0 +1,261 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from time import time
+
+from schema import expand_matrix, get_needs, get_uuid, sort_jobs
+
+# task states
+WAITING = 'waiting'
+QUEUED = 'queued'
+LEASED = 'leased'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+DONE_STATES = (SUCCEEDED, FAILED, SKIPPED)
+
+
+class Task:
+    def __init__(self, task_id: str, run, job_name: str, job: dict, matrix: dict = None):
+        self.id = task_id
+        self.run = run
+        self.job_name = job_name
+        self.job = job
+        self.matrix = matrix or {}
+        self.state = WAITING
+        self.worker = None
+        self.deadline = 0
+        self.attempts = 0
+        self.timing = None
+
+    def assignment(self, lease_ttl: float) -> dict:
+        return {
+            "id": self.id,
+            "run": self.run.name,
+            "namespace": self.run.namespace,
+            "flow": self.run.flow,
+            "repository": self.run.repository,
+            "job_name": self.job_name,
+            "job": self.job,
+            "matrix": self.matrix,
+            "attempt": self.attempts,
+            "lease_ttl": lease_ttl,
+        }
+
+
+class Run:
+    # one flow run, a task per job(or matrix combination) released when its needs succeeded
+    def __init__(self, namespace: str, name: str, flow: str, repository: str, secrets: str, jobs: dict,
+                 labels: dict = None):
+        self.namespace = namespace
+        self.name = name
+        self.flow = flow
+        self.repository = repository
+        # workers only lease runs of the secret they mounted
+        self.secrets = secrets
+        self.labels = labels or {}
+        self.cancelled = False
+        self.tasks = OrderedDict()
+        self.by_job = {}
+        self.needs = {}
+        for job_name in sort_jobs(jobs):
+            job = jobs[job_name]
+            self.needs[job_name] = get_needs(job)
+            combinations = expand_matrix((job.get('strategy') or {}).get('matrix') or {}) or [None]
+            self.by_job[job_name] = []
+            for idx, matrix in enumerate(combinations):
+                task_id = f"{name}-{job_name}" if matrix is None else f"{name}-{job_name}-{idx}"
+                task = Task(task_id, self, job_name, job, matrix)
+                self.tasks[task_id] = task
+                self.by_job[job_name].append(task)
+
+    def ready(self) -> list:
+        # waiting tasks whose needs all succeeded
+        result = []
+        for task in self.tasks.values():
+            if task.state != WAITING:
+                continue
+            if all(t.state == SUCCEEDED for need in self.needs[task.job_name] for t in self.by_job[need]):
+                result.append(task)
+        return result
+
+    def skip_blocked(self):
+        # a failed need never succeeds, skip everything depending on it
+        changed = True
+        while changed:
+            changed = False
+            for task in self.tasks.values():
+                if task.state != WAITING:
+                    continue
+                if any(t.state in (FAILED, SKIPPED) for need in self.needs[task.job_name] for t in self.by_job[need]):
+                    task.state = SKIPPED
+                    changed = True
+
+    @property
+    def phase(self) -> str:
+        # same names as argo workflow phases, the concurrency scheduler checks both
+        states = [t.state for t in self.tasks.values()]
+        if not all(s in DONE_STATES for s in states):
+            return 'Running' if any(s != WAITING and s != QUEUED for s in states) else 'Pending'
+        if self.cancelled or any(s == FAILED for s in states):
+            return 'Failed'
+        return 'Succeeded'
+
+
+class JobQueue:
+    # in-memory queue of the warm runner pool, lost with the api-server like the concurrency groups
+    def __init__(self, lease_ttl: float = 60, max_attempts: int = 3, keep_finished: int = 100):
+        self.lease_ttl = lease_ttl
+        self.max_attempts = max_attempts
+        self.keep_finished = keep_finished
+        self.runs = OrderedDict()
+        self.tasks = {}
+        self.queued = deque()
+        # created by the first wait_lease, an Event made at import binds to a loop aiohttp does not serve on
+        self.available = None
+        self.leased = 0
+        self.expired = 0
+        self.completed = 0
+
+    def submit(self, namespace: str, flow: str, repository: str, secrets: str, jobs: dict,
+               labels: dict = None) -> str:
+        name = f"{flow}-{get_uuid()}"
+        run = Run(namespace, name, flow, repository, secrets, jobs, labels)
+        self.runs[name] = run
+        self.tasks.update(run.tasks)
+        self._release(run)
+        self._prune()
+        return name
+
+    def _release(self, run: Run):
+        run.skip_blocked()
+        for task in run.ready():
+            task.state = QUEUED
+            self.queued.append(task)
+        if self.queued:
+            self._notify()
+
+    def _prune(self):
+        finished = [name for name, run in self.runs.items() if run.phase in ('Succeeded', 'Failed')]
+        for name in finished[:max(0, len(finished) - self.keep_finished)]:
+            for task_id in self.runs.pop(name).tasks:
+                self.tasks.pop(task_id, None)
+
+    def expire(self):
+        # leases not renewed in time go back to the queue, a pod was killed or lost its network
+        now = time()
+        for task in self.tasks.values():
+            if task.state != LEASED or task.deadline > now:
+                continue
+            self.expired += 1
+            logging.info(f'lease of {task.id} by {task.worker} expired')
+            task.worker = None
+            if task.attempts >= self.max_attempts or task.run.cancelled:
+                task.state = FAILED
+                self._release(task.run)
+            else:
+                task.state = QUEUED
+                self.queued.appendleft(task)
+                self._notify()
+
+    def lease(self, worker: str, secrets: str = None):
+        self.expire()
+        for _ in range(len(self.queued)):
+            task = self.queued.popleft()
+            if task.state != QUEUED:
+                continue
+            if task.run.secrets != secrets:
+                self.queued.append(task)
+                continue
+            task.state = LEASED
+            task.worker = worker
+            task.attempts += 1
+            task.deadline = time() + self.lease_ttl
+            self.leased += 1
+            return task.assignment(self.lease_ttl)
+        if self.available is not None:
+            self.available.clear()
+        return None
+
+    def _notify(self):
+        # no waiter yet when there is no event
+        if self.available is not None:
+            self.available.set()
+
+    async def wait_lease(self, worker: str, secrets: str = None, wait: float = 0):
+        # long poll, an idle worker gets a job as soon as it is queued
+        loop = asyncio.get_event_loop()
+        if self.available is None:
+            self.available = asyncio.Event()
+        deadline = loop.time() + wait
+        while True:
+            assignment = self.lease(worker, secrets)
+            timeout = deadline - loop.time()
+            if assignment or timeout <= 0:
+                return assignment
+            try:
+                await asyncio.wait_for(self.available.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            else:
+                # other workers may take it, yield before the next try
+                await asyncio.sleep(0)
+
+    def _owned(self, task_id: str, worker: str):
+        task = self.tasks.get(task_id)
+        if not task or task.state != LEASED or task.worker != worker:
+            return None
+        return task
+
+    def heartbeat(self, task_id: str, worker: str) -> bool:
+        task = self._owned(task_id, worker)
+        if not task or task.run.cancelled:
+            return False
+        task.deadline = time() + self.lease_ttl
+        return True
+
+    def complete(self, task_id: str, worker: str, succeeded: bool, timing: dict = None) -> bool:
+        task = self._owned(task_id, worker)
+        if not task:
+            return False
+        self.completed += 1
+        task.state = SUCCEEDED if succeeded else FAILED
+        task.worker = None
+        task.timing = timing
+        self._release(task.run)
+        return True
+
+    def cancel(self, name: str):
+        # leased tasks end now, their worker stops the job when the next heartbeat is refused
+        run = self.runs.get(name)
+        if not run:
+            return
+        run.cancelled = True
+        for task in run.tasks.values():
+            if task.state in (WAITING, QUEUED, LEASED):
+                task.state = SKIPPED
+                task.worker = None
+
+    def phase(self, name: str):
+        self.expire()
+        run = self.runs.get(name)
+        return run.phase if run else None
+
+    def find_running(self, namespace: str, labels: dict):
+        for name, run in reversed(self.runs.items()):
+            if run.namespace == namespace and run.phase not in ('Succeeded', 'Failed') \
+                    and all(run.labels.get(k) == v for k, v in labels.items()):
+                return name
+        return None
+
+    def metrics(self) -> dict:
+        states = {}
+        for task in self.tasks.values():
+            states[task.state] = states.get(task.state, 0) + 1
+        return {
+            "runs": len(self.runs),
+            "tasks": states,
+            "leased": self.leased,
+            "expired": self.expired,
+            "completed": self.completed,
+        }
@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import logging
+import re
+
+CONCURRENCY_LABEL = 'kubeaction.spaceone.dev/concurrency-group'
+FINISHED_PHASES = ('Succeeded', 'Failed', 'Error')
+GROUP_PATTERN = re.compile(r'\$\{\{\s*([\w.-]+)\s*\}\}')
+
+
+def get_concurrency(spec: dict):
+    # concurrency: <group> or concurrency: {group: <group>, cancel-in-progress: true}
+    concurrency = spec.get('concurrency')
+    if not concurrency:
+        return None, False
+    if isinstance(concurrency, str):
+        return concurrency, False
+    return concurrency.get('group'), bool(concurrency.get('cancel-in-progress'))
+
+
+def event_context(flow: dict, event: dict, data: dict) -> dict:
+    return {
+        "flow": flow['metadata']['name'],
+        "github": {
+            "event_name": event.get('event_type_name'),
+            "ref": data.get('ref', ''),
+            "sha": data.get('after', ''),
+            "repository": (data.get('repository') or {}).get('full_name', ''),
+        },
+    }
+
+
+def render_group(group: str, ctx: dict) -> str:
+    # only plain context lookups, e.g. ${{ github.ref }}
+    def lookup(m):
+        value = ctx
+        for part in m.group(1).split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        return '' if value is None else f'{value}'
+
+    return GROUP_PATTERN.sub(lookup, group)
+
+
+def group_label(key: str) -> str:
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+class GroupState:
+    def __init__(self):
+        self.running = None
+        self.pending = None
+        # running is looked up once, under the lock, after a restart
+        self.loaded = False
+        self.lock = asyncio.Lock()
+
+
+class ConcurrencyScheduler:
+    # one run per concurrency group, queued runs collapse into the latest event
+    def __init__(self, start_run, cancel_run, get_phase, find_running, poll_interval: float = 5):
+        self.start_run = start_run
+        self.cancel_run = cancel_run
+        self.get_phase = get_phase
+        self.find_running = find_running
+        self.poll_interval = poll_interval
+        self.groups = {}
+        self.started = 0
+        self.coalesced = 0
+        self.cancelled = 0
+
+    async def _start(self, flow: dict, event: dict, labels: dict = None):
+        self.started += 1
+        return await self.start_run(flow, event, labels or {})
+
+    async def submit(self, flow: dict, event: dict, data: dict):
+        group, cancel_in_progress = get_concurrency(flow.get('spec', {}))
+        if not group:
+            await self._start(flow, event)
+            return
+        namespace = flow['metadata']['namespace']
+        key = f"{namespace}/{render_group(group, event_context(flow, event, data))}"
+        labels = {CONCURRENCY_LABEL: group_label(key)}
+        while True:
+            state = self.groups.get(key)
+            if state is None:
+                state = self.groups[key] = GroupState()
+            async with state.lock:
+                if self.groups.get(key) is not state:
+                    # finished and removed by _advance while waiting for the lock
+                    continue
+                await self._submit(key, state, namespace, flow, event, labels, cancel_in_progress)
+                return
+
+    async def _submit(self, key: str, state: GroupState, namespace: str, flow: dict, event: dict, labels: dict,
+                      cancel_in_progress: bool):
+        if not state.loaded:
+            # after a restart, a run of this group may still be in progress
+            state.running = await self.find_running(namespace, labels)
+            state.loaded = True
+        if state.running and cancel_in_progress:
+            logging.info(f'cancel {state.running} of concurrency group {key}')
+            await self.cancel_run(namespace, state.running)
+            self.cancelled += 1
+            state.running = None
+        if state.running:
+            if state.pending:
+                self.coalesced += 1
+            state.pending = (flow, event, labels)
+            return
+        state.running = await self._start(flow, event, labels)
+
+    async def poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for key, state in list(self.groups.items()):
+                try:
+                    await self._advance(key, state)
+                except Exception:
+                    logging.exception(f'fail to advance concurrency group {key}')
+
+    async def _advance(self, key: str, state: GroupState):
+        async with state.lock:
+            if not state.loaded or self.groups.get(key) is not state:
+                return
+            if state.running:
+                namespace = key.split('/', 1)[0]
+                phase = await self.get_phase(namespace, state.running)
+                if phase and phase not in FINISHED_PHASES:
+                    return
+                state.running = None
+            if state.pending:
+                flow, event, labels = state.pending
+                state.pending = None
+                state.running = await self._start(flow, event, labels)
+            else:
+                del self.groups[key]
+
+    def metrics(self) -> dict:
+        return {
+            "groups": len(self.groups),
+            "pending": sum(1 for s in self.groups.values() if s.pending),
+            "started": self.started,
+            "coalesced": self.coalesced,
+            "cancelled": self.cancelled,
+        }
@@ -1,3 +1,7 @@
+import base64
+import gzip
+import hashlib
+import itertools
 import json
 import os
 from dataclasses import dataclass
@@ -8,13 +12,70 @@ import shortuuid
 from dotenv import load_dotenv
 from kopf.engines import logging
 
+try:
+    from client_helper import OWNER_LABEL, SPEC_HASH_ANNOTATION
+except Exception:
+    from .client_helper import OWNER_LABEL, SPEC_HASH_ANNOTATION
+
 load_dotenv(verbose=True)
 
 
+ACTION_CACHE_PATH = '/cache/actions'
+JOB_PAYLOAD_PATH = '/kubeaction/jobs'
+
+# a docker data root can only be used by one dockerd at a time,
+# every dind sidecar locks a free slot of the shared cache volume for the pod lifetime
+DIND_CACHE_SCRIPT = """
+for i in $(seq 0 $((DIND_CACHE_SLOTS-1))); do
+  exec 9>/cache/dind/slot-$i.lock
+  if flock -n 9; then
+    exec dockerd-entrypoint.sh --data-root /cache/dind/slot-$i $DIND_ARGS
+  fi
+done
+echo 'no free dind cache slot, start with empty data root'
+exec dockerd-entrypoint.sh $DIND_ARGS
+"""
+
+
 def get_uuid():
     return shortuuid.uuid().lower()[:5]
 
 
+def spec_hash(spec) -> str:
+    # stable over key order, used to skip writes of unchanged objects
+    return hashlib.sha256(json.dumps(spec, sort_keys=True, separators=(',', ':')).encode()).hexdigest()[:16]
+
+
+def get_kubeaction_api():
+    return os.environ.get('KUBEACTION_API') \
+           or f"http://{os.environ.get('API_SERVICE')}.{os.environ.get('API_NAMESPACE')}.svc.cluster.local:{os.environ.get('API_PORT')}/events"
+
+
+def get_kubeaction_gateway_api():
+    # shared webhook gateway posts its events here
+    api = get_kubeaction_api()
+    return os.environ.get('KUBEACTION_GATEWAY_API') or f"{api[:-len('/events')] if api.endswith('/events') else api}/gateway"
+
+
+# shared webhook mode, one event source/gateway for every EventType
+SHARED_WEBHOOK_NAME = 'kubeaction-webhook'
+# event source route key -> event_type_name, read by the api-server
+WEBHOOK_ROUTES = 'kubeaction-webhook-routes'
+
+
+def get_shared_webhook_namespace():
+    return os.environ.get('SHARED_WEBHOOK_NAMESPACE', 'kubeaction')
+
+
+def get_shared_webhook_port():
+    return int(os.environ.get('SHARED_WEBHOOK_PORT', '12000'))
+
+
+def webhook_route_key(namespace: str, name: str, event: str) -> str:
+    # kubernetes names have no `_`, so `<namespace>_<name>_` prefixes the routes of one EventType
+    return f"{namespace}_{name}_{event}"
+
+
 class Resource:
     def to_dict(self):
         raise NotImplementedError('you must overwrite to_dict')
@@ -26,6 +87,61 @@ class FlowInfo:
     repo: str
     github_token: dict
     secrets: dict
+    # name of the JobPayload config map, jobs are embedded in the templates when not set
+    jobs_configmap: str = None
+
+    @classmethod
+    def from_metadata(cls, name: str, metadata: dict, jobs_configmap: str = None):
+        return cls(
+            name=name,
+            repo=metadata.get('repository', ''),
+            github_token=metadata.get('github_token'),
+            secrets=metadata.get('secrets'),
+            jobs_configmap=jobs_configmap,
+        )
+
+
+class JobPayload(Resource):
+    # jobs of a flow stored once in a config map named by content hash and mounted into the job pods,
+    # instead of a copy in every event, cron workflow, workflow and template
+    def __init__(self, namespace: str, flow: str, jobs: dict):
+        self.namespace = namespace
+        self.flow = flow
+        self.jobs = jobs
+
+    @staticmethod
+    def enabled() -> bool:
+        return os.environ.get('JOB_PAYLOAD_CONFIGMAP') == 'true'
+
+    @staticmethod
+    def file_name() -> str:
+        return 'jobs.json.gz' if os.environ.get('JOB_PAYLOAD_GZIP') == 'true' else 'jobs.json'
+
+    @property
+    def name(self) -> str:
+        return f"{self.flow}-jobs-{spec_hash([self.file_name(), self.jobs])[:10]}"
+
+    def to_dict(self):
+        raw = json.dumps(self.jobs).encode()
+        resource = {
+            "apiVersion": "v1",
+            "kind": "ConfigMap",
+            "metadata": {"name": self.name, "namespace": self.namespace, "labels": {OWNER_LABEL: self.flow}},
+            # content never changes under the same name, kubelet does not need to watch it
+            "immutable": True,
+        }
+        if self.file_name().endswith('.gz'):
+            # mtime=0 keeps the compressed bytes stable
+            resource['binaryData'] = {self.file_name(): base64.b64encode(gzip.compress(raw, mtime=0)).decode()}
+        else:
+            resource['data'] = {self.file_name(): raw.decode()}
+        return resource
+
+    @classmethod
+    def load(cls, data: dict) -> dict:
+        if 'jobs.json.gz' in data:
+            return json.loads(gzip.decompress(data['jobs.json.gz']))
+        return json.loads(data['jobs.json'])
 
 
 class CustomObject(Resource):
@@ -50,15 +166,20 @@ class CustomObject(Resource):
             meta['namespace'] = self.namespace
         return meta
 
-    def to_dict(self, adopt=True):
+    def to_dict(self, adopt=True, owner: str = None):
+        spec = self.get_spec()
+        metadata = self.get_metadata()
+        metadata.setdefault('annotations', {})[SPEC_HASH_ANNOTATION] = spec_hash(spec)
         resource = {
             "apiVersion": self.apiVersion,
             "kind": self.kind,
-            "metadata": self.get_metadata(),
-            "spec": self.get_spec()
+            "metadata": metadata,
+            "spec": spec
         }
         if adopt:
             kopf.adopt(resource)
+        if owner:
+            resource['metadata'].setdefault('labels', {})[OWNER_LABEL] = owner
         return resource
 
 
@@ -146,6 +267,17 @@ class ArgoWebHookGateway(ArgoGateway):
         )
 
 
+class ArgoSharedWebHookGateway(ArgoGateway):
+    # no sensor, the gateway posts to the api-server which resolves the route
+    def __init__(self, namespace: str, name: str, port: int, replica: int = 1,
+                 service_account: str = "argo-events-sa"):
+        super(ArgoSharedWebHookGateway, self).__init__(
+            namespace, name, "webhook", event_source_name=name, replica=replica,
+            service={"ports": [{"port": port, "targetPort": port}]}, service_account=service_account,
+            subscribers={"http": [get_kubeaction_gateway_api()]}
+        )
+
+
 class ArgoSensor(ArgoObject):
     kind = 'Sensor'
 
@@ -206,11 +338,210 @@ class StepsWorkflowTemplates(Resource):
         }
 
 
+class DagWorkflowTemplates(Resource):
+    def __init__(self, dependencies: dict, name="jobs"):
+        self.name = name
+        # template name -> names of templates it depends on
+        self.dependencies = dependencies
+
+    def to_dict(self):
+        tasks = []
+        for name, deps in self.dependencies.items():
+            task = {"name": name, "template": name}
+            if deps:
+                task['dependencies'] = list(deps)
+            tasks.append(task)
+        return {
+            "name": self.name,
+            "dag": {
+                "tasks": tasks
+            }
+        }
+
+
+def expand_matrix(matrix: dict) -> list:
+    # https://docs.github.com/en/actions/reference/workflow-syntax-for-github-actions#jobsjob_idstrategymatrix
+    include = matrix.get('include') or []
+    exclude = matrix.get('exclude') or []
+    axes = {k: v for k, v in matrix.items() if k not in ('include', 'exclude')}
+    combinations = []
+    if axes:
+        combinations = [dict(zip(axes.keys(), values)) for values in itertools.product(*axes.values())]
+    combinations = [c for c in combinations
+                    if not any(all(c.get(k) == v for k, v in ex.items()) for ex in exclude)]
+    # includes extend the combinations of the axes, entries added by an earlier include may lack axis keys
+    original = list(combinations)
+    for inc in include:
+        matched = [c for c in original if all(c.get(k) == v for k, v in inc.items() if k in axes)]
+        if matched and axes:
+            for c in matched:
+                c.update({k: v for k, v in inc.items() if k not in axes})
+        else:
+            combinations.append(dict(inc))
+    return combinations
+
+
+class MatrixWorkflowTemplates(Resource):
+    def __init__(self, name: str, template_name: str, combinations: list, max_parallel: int = None,
+                 fail_fast: bool = True):
+        self.name = name
+        self.template_name = template_name
+        self.combinations = combinations
+        self.max_parallel = max_parallel
+        self.fail_fast = fail_fast
+
+    def to_dict(self):
+        tasks = [
+            {
+                "name": f"{self.name}-{idx}",
+                "template": self.template_name,
+                "arguments": {"parameters": [{"name": "matrix", "value": json.dumps(c)}]},
+            }
+            for idx, c in enumerate(self.combinations)
+        ]
+        data = {
+            "name": self.name,
+            # failFast stops scheduling the rest of the matrix once one combination fails
+            "dag": {"tasks": tasks, "failFast": self.fail_fast},
+        }
+        if self.max_parallel:
+            data['parallelism'] = self.max_parallel
+        return data
+
+
+def get_needs(job: dict) -> list:
+    needs = job.get('needs') or []
+    if isinstance(needs, str):
+        return [needs]
+    return list(needs)
+
+
+def sort_jobs(jobs: dict) -> list:
+    # topological order of job names, fails on unknown needs and cycles
+    for name, job in jobs.items():
+        for need in get_needs(job):
+            if need not in jobs:
+                raise kopf.PermanentError(f"job {name} needs unknown job {need}")
+    remain = {name: set(get_needs(job)) for name, job in jobs.items()}
+    ordered = []
+    while remain:
+        ready = [name for name, needs in remain.items() if not needs]
+        if not ready:
+            raise kopf.PermanentError(f"jobs have circular needs: {', '.join(sorted(remain))}")
+        for name in ready:
+            del remain[name]
+            ordered.append(name)
+        for needs in remain.values():
+            needs.difference_update(ready)
+    return ordered
+
+
+def pack_jobs(jobs: dict) -> list:
+    # JOB_PACKING=true: jobs with the same runs-on and needs run in one pod, within PACK_MAX_JOBS and PACK_MAX_STEPS.
+    # secrets are mounted per flow, so jobs of a flow never conflict on them. matrix jobs are never packed, and neither
+    # are jobs other jobs need: a pack fails as a whole, a dependent would be skipped by a sibling's failure
+    order = sort_jobs(jobs)
+    if os.environ.get('JOB_PACKING') != 'true':
+        return [[name] for name in order]
+    max_jobs = int(os.environ.get('PACK_MAX_JOBS', '4'))
+    max_steps = int(os.environ.get('PACK_MAX_STEPS', '20'))
+    needed = {need for job in jobs.values() for need in get_needs(job)}
+    packs = []
+    open_packs = {}
+    for name in order:
+        job = jobs[name]
+        steps = len(job.get('steps') or [])
+        if (job.get('strategy') or {}).get('matrix') or name in needed:
+            packs.append([name])
+            continue
+        key = json.dumps([job.get('runs-on'), sorted(get_needs(job))])
+        pack = open_packs.get(key)
+        if pack is None or len(pack['jobs']) >= max_jobs or pack['steps'] + steps > max_steps:
+            pack = open_packs[key] = {"jobs": [], "steps": 0}
+            packs.append(pack['jobs'])
+        pack['jobs'].append(name)
+        pack['steps'] += steps
+    return packs
+
+
+def pack_names(packs: list, jobs: dict) -> list:
+    # template name per pack, <first>-pack unless a job or its matrix template already uses the name
+    taken = {"jobs", *jobs, *(f"{name}-job" for name in jobs)}
+    names = []
+    for pack in packs:
+        if len(pack) == 1:
+            names.append(pack[0])
+            continue
+        name, idx = f"{pack[0]}-pack", 1
+        while name in taken:
+            name, idx = f"{pack[0]}-pack-{idx}", idx + 1
+        taken.add(name)
+        names.append(name)
+    return names
+
+
+def critical_path(jobs: dict) -> list:
+    # longest chain of needs, flow takes at least this many jobs in series
+    longest = {}
+    for name in sort_jobs(jobs):
+        needs = get_needs(jobs[name])
+        prev = max((longest[n] for n in needs), key=len, default=[])
+        longest[name] = prev + [name]
+    return max(longest.values(), key=len, default=[])
+
+
+DIND_CACHE_MODES = ('hostpath', 'pvc')
+
+
+def get_dind_cache():
+    # DIND_CACHE, one check for the sidecar mount and the volume
+    mode = os.environ.get('DIND_CACHE')
+    if not mode:
+        return None
+    if mode not in DIND_CACHE_MODES:
+        raise kopf.PermanentError(f"DIND_CACHE must be one of {', '.join(DIND_CACHE_MODES)}, not {mode}")
+    if mode == 'pvc' and not os.environ.get('DIND_CACHE_CLAIM'):
+        raise kopf.PermanentError("DIND_CACHE_CLAIM must be set for DIND_CACHE=pvc")
+    return mode
+
+
+def get_dind_sidecar() -> dict:
+    args = []
+    mirror = os.environ.get('DIND_REGISTRY_MIRROR')
+    if mirror:
+        args += ['--registry-mirror', mirror]
+    sidecar = {
+        "name": "dind",
+        "image": "docker:17.10-dind",
+        "securityContext": {
+            "privileged": True,
+        },
+        "mirrorVolumeMounts": True
+    }
+    if get_dind_cache():
+        sidecar['command'] = ['sh', '-c', DIND_CACHE_SCRIPT]
+        sidecar['env'] = [
+            {"name": "DIND_CACHE_SLOTS", "value": os.environ.get('DIND_CACHE_SLOTS', '4')},
+            {"name": "DIND_ARGS", "value": ' '.join(args)},
+        ]
+        sidecar['volumeMounts'] = [{"name": "dind-cache", "mountPath": "/cache/dind"}]
+    elif args:
+        sidecar['args'] = args
+    return sidecar
+
+
 class JobWorkflowTemplate(Resource):
     def __init__(self, name: str, job: str, flow_info: FlowInfo, cmd: list = None,
                  image: str = None,
+                 template_name: str = None,
+                 matrix: bool = False,
+                 pack: list = None,
                  ):
         self.name = name
+        self.template_name = template_name or name
+        self.matrix = matrix
+        # names of packed jobs, job is then a dict of them
+        self.pack = pack
         self.job = job
         self.image = image or os.environ.get('KUBEACTION_JOB_IMAGE', "spaceone/kubeaction-job:latest")
         self.cmd = cmd or ["python3 /src/job.py"]
@@ -234,7 +565,6 @@ class JobWorkflowTemplate(Resource):
         DIND_MODE = os.environ.get('DIND_MODE', 'false')
         env = [
             {"name": "KUBEACTION_NAME", "value": self.name},
-            {"name": "KUBEACTION_JOB", "value": json.dumps(self.job)},
             {"name": "KUBEACTION_FLOW", "value": self.flow_info.name},
             {"name": "KUBEACTION_REPOSITORY", "value": self.flow_info.repo},
             {"name": "DOCKER_HOST", "value": "127.0.0.1:2375"},
@@ -242,6 +572,22 @@ class JobWorkflowTemplate(Resource):
 
         ]
         volume_mounts = []
+        if self.flow_info.jobs_configmap:
+            env.append({"name": "KUBEACTION_JOB_PATH", "value": f"{JOB_PAYLOAD_PATH}/{JobPayload.file_name()}"})
+            volume_mounts.append({"name": "job-payload", "mountPath": JOB_PAYLOAD_PATH, "readOnly": True})
+        else:
+            env.append({"name": "KUBEACTION_JOB", "value": json.dumps(self.job)})
+        if os.environ.get('REPORT_JOB_TIMING') == 'true':
+            env.append({"name": "KUBEACTION_API", "value": get_kubeaction_api()})
+        if os.environ.get('ACTION_IMAGE_PULL_POLICY'):
+            env.append({"name": "KUBEACTION_IMAGE_PULL_POLICY", "value": os.environ.get('ACTION_IMAGE_PULL_POLICY')})
+        if os.environ.get('ACTION_CACHE_CLAIM'):
+            env.append({"name": "KUBEACTION_ACTION_CACHE", "value": ACTION_CACHE_PATH})
+            env.append({"name": "KUBEACTION_ACTION_CACHE_SIZE", "value": os.environ.get('ACTION_CACHE_SIZE', '1024')})
+            volume_mounts.append({
+                "name": "action-cache",
+                "mountPath": ACTION_CACHE_PATH,
+            })
         if self.flow_info.secrets:
             if self.flow_info.secrets.get('provider') == 'kubernetes':
                 volume_mounts.append({
@@ -252,8 +598,12 @@ class JobWorkflowTemplate(Resource):
         github_token = self.get_github_token()
         if github_token:
             env.append(github_token)
+        if self.matrix:
+            env.append({"name": "KUBEACTION_MATRIX", "value": "{{inputs.parameters.matrix}}"})
+        if self.pack:
+            env.append({"name": "KUBEACTION_PACK", "value": json.dumps(self.pack)})
         data = {
-            "name": self.name,
+            "name": self.template_name,
             "container": {
                 "image": self.image,
                 "imagePullPolicy": "Always",
@@ -263,31 +613,53 @@ class JobWorkflowTemplate(Resource):
             },
         }
         if DIND_MODE == 'true':
-            data['sidecars'] = [
-                {
-                    "name": "dind",
-                    "image": "docker:17.10-dind",
-                    "securityContext": {
-                        "privileged": True,
-                    },
-                    "mirrorVolumeMounts": True
-                }
-            ]
+            data['sidecars'] = [get_dind_sidecar()]
 
+        if self.matrix:
+            data['inputs'] = {"parameters": [{"name": "matrix"}]}
         return data
 
+    @classmethod
+    def job_templates(cls, name: str, job: dict, flow_info: FlowInfo) -> list:
+        strategy = job.get('strategy') or {}
+        if not strategy.get('matrix'):
+            return [cls(name, job, flow_info=flow_info)]
+        combinations = expand_matrix(strategy['matrix'])
+        if not combinations:
+            raise kopf.PermanentError(f"matrix of job {name} has no combination")
+        template_name = f"{name}-job"
+        return [
+            cls(name, job, flow_info=flow_info, template_name=template_name, matrix=True),
+            MatrixWorkflowTemplates(name, template_name, combinations,
+                                    max_parallel=strategy.get('max-parallel'),
+                                    fail_fast=strategy.get('fail-fast', True)),
+        ]
+
+    @classmethod
+    def pack_templates(cls, name: str, pack: list, jobs: dict, flow_info: FlowInfo) -> list:
+        if len(pack) == 1:
+            return cls.job_templates(pack[0], jobs[pack[0]], flow_info=flow_info)
+        return [cls(name, {job_name: jobs[job_name] for job_name in pack}, flow_info=flow_info, pack=pack)]
+
     @classmethod
     def from_flow_jobs(cls, jobs: dict, flow_info: FlowInfo) -> dict:
         has_needs = any([j.get('needs') for j in jobs.values()])
         templates = []
         entrypoint: str = None
+        packs = pack_jobs(jobs)
+        names = pack_names(packs, jobs)
+        for name, pack in zip(names, packs):
+            templates.extend(cls.pack_templates(name, pack, jobs, flow_info=flow_info))
         if has_needs:
-            # make DAG templates
-            pass
+            # needed jobs are never packed, so a need is always on the job's own template.
+            # jobs of a pack have the same needs
+            position = {name: i for i, name in enumerate(jobs)}
+            templates.append(DagWorkflowTemplates({
+                name: get_needs(jobs[pack[0]])
+                for name, pack in sorted(zip(names, packs), key=lambda p: position[p[1][0]])}))
+            entrypoint = "jobs"
         else:
-            for name, job in jobs.items():
-                templates.append(cls(name, job, flow_info=flow_info))
-            templates.append(StepsWorkflowTemplates(jobs.keys()))
+            templates.append(StepsWorkflowTemplates(names))
             entrypoint = "jobs"
 
         return {
@@ -296,6 +668,26 @@ class JobWorkflowTemplate(Resource):
         }
 
 
+def get_workflow_volumes(flow_info: FlowInfo) -> list:
+    volumes = []
+    if flow_info.jobs_configmap:
+        volumes.append({"name": "job-payload", "configMap": {"name": flow_info.jobs_configmap}})
+    if flow_info.secrets:
+        if flow_info.secrets.get('provider') == 'kubernetes':
+            volumes.append({"name": "secrets", "secret": {"secretName": flow_info.secrets.get('name')}})
+    action_cache_claim = os.environ.get('ACTION_CACHE_CLAIM')
+    if action_cache_claim:
+        volumes.append({"name": "action-cache", "persistentVolumeClaim": {"claimName": action_cache_claim}})
+    dind_cache = get_dind_cache()
+    if dind_cache == 'hostpath':
+        volumes.append({"name": "dind-cache", "hostPath": {
+            "path": os.environ.get('DIND_CACHE_PATH', '/var/lib/kubeaction/dind'), "type": "DirectoryOrCreate"}})
+    elif dind_cache == 'pvc':
+        volumes.append({"name": "dind-cache",
+                        "persistentVolumeClaim": {"claimName": os.environ.get('DIND_CACHE_CLAIM')}})
+    return volumes
+
+
 class ArgoWorkflow(ArgoObject):
     kind = 'Workflow'
 
@@ -313,55 +705,181 @@ class ArgoWorkflow(ArgoObject):
         }
 
     @classmethod
-    def from_flow(cls, namespace: str, name: str, jobs: dict, flow_info: FlowInfo, spec: dict = {}, **kwargs):
+    def from_flow(cls, namespace: str, name: str, jobs: dict, flow_info: FlowInfo, spec: dict = None, **kwargs):
+        spec = dict(spec or {})
         logging.info(f"flow_info_secrets {flow_info.secrets}")
-        if flow_info.secrets:
-            if flow_info.secrets.get('provider') == 'kubernetes':
-                spec['volumes'] = [
-                    {"name": "secrets", "secret": {"secretName": flow_info.secrets.get('name')}}
-                ]
+        volumes = get_workflow_volumes(flow_info)
+        if volumes:
+            spec['volumes'] = volumes
         logging.info(f"{spec}")
         return cls(namespace, name, **JobWorkflowTemplate.from_flow_jobs(jobs=jobs, flow_info=flow_info), spec=spec,
                    **kwargs)
 
 
+CONCURRENCY_POLICIES = {'allow': 'Allow', 'forbid': 'Forbid', 'replace': 'Replace'}
+
+
+def get_seconds(key: str, value) -> int:
+    try:
+        seconds = int(value)
+    except (TypeError, ValueError):
+        raise kopf.PermanentError(f"{key} must be a number of seconds, got {value}")
+    if seconds < 0:
+        raise kopf.PermanentError(f"{key} must not be negative, got {value}")
+    return seconds
+
+
+def get_schedule_options(schedule: dict) -> dict:
+    # on.schedule[].<concurrency-policy|starting-deadline|jitter>, defaults from CRON_* env
+    options = {}
+    policy = schedule.get('concurrency-policy', os.environ.get('CRON_CONCURRENCY_POLICY'))
+    if policy:
+        if str(policy).lower() not in CONCURRENCY_POLICIES:
+            raise kopf.PermanentError(f"concurrency-policy must be one of {', '.join(CONCURRENCY_POLICIES)}")
+        options['concurrency_policy'] = CONCURRENCY_POLICIES[str(policy).lower()]
+    deadline = schedule.get('starting-deadline', os.environ.get('CRON_STARTING_DEADLINE'))
+    if deadline is not None:
+        options['starting_deadline'] = get_seconds('starting-deadline', deadline)
+    jitter = schedule.get('jitter', os.environ.get('CRON_JITTER'))
+    if jitter:
+        options['jitter'] = get_seconds('jitter', jitter)
+    return options
+
+
+def jitter_offset(key: str, window: int) -> int:
+    # deterministic, the same flow always lands on the same second of the window
+    if window <= 0:
+        return 0
+    return int(hashlib.sha1(key.encode()).hexdigest()[:8], 16) % window
+
+
+CRON_DESCRIPTORS = {'@yearly': 86400, '@annually': 86400, '@monthly': 86400, '@weekly': 86400, '@daily': 86400,
+                    '@midnight': 86400, '@hourly': 3600}
+
+
+def cron_field_interval(field: str, unit: int, size: int):
+    # shortest gap of one cron field, None when it is a single value
+    if field == '*':
+        return unit
+    if field.startswith('*/') and field[2:].isdigit():
+        return int(field[2:]) * unit
+    if ',' in field and all(v.isdigit() for v in field.split(',')):
+        values = sorted(int(v) for v in field.split(','))
+        return min(b - a for a, b in zip(values, values[1:] + [values[0] + size])) * unit
+    return None if field.isdigit() else unit
+
+
+def cron_interval(cron: str) -> int:
+    # shortest time between two runs in seconds, from the minute and hour fields. unknown forms count as a minute
+    fields = cron.split()
+    if fields and fields[0] in CRON_DESCRIPTORS:
+        return CRON_DESCRIPTORS[fields[0]]
+    if len(fields) != 5:
+        return 60
+    minute = cron_field_interval(fields[0], 60, 60)
+    if minute is not None:
+        return minute
+    hour = cron_field_interval(fields[1], 3600, 24)
+    return hour if hour is not None else 86400
+
+
+def shift_cron(cron: str, offset: int) -> tuple:
+    # whole minutes go to a numeric minute field, the rest is a delay step in the workflow
+    fields = cron.split()
+    minutes, seconds = divmod(offset, 60)
+    if minutes and len(fields) == 5 and fields[0].isdigit() and int(fields[0]) + minutes < 60:
+        fields[0] = str(int(fields[0]) + minutes)
+        return ' '.join(fields), seconds
+    # past the end of the hour the minute would wrap and fire early, the whole offset is a delay then
+    return cron, offset
+
+
+class JitterWorkflowTemplates(Resource):
+    # suspend without a pod, then the jobs template. kubeaction- names are reserved, jobs can not use them
+    delay_name = "kubeaction-jitter"
+
+    def __init__(self, delay: int, jobs_template: str = "jobs", name="kubeaction-scheduled"):
+        self.name = name
+        self.delay = delay
+        self.jobs_template = jobs_template
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "steps": [
+                [{"name": self.delay_name, "template": self.delay_name}],
+                [{"name": self.jobs_template, "template": self.jobs_template}],
+            ]
+        }
+
+    @classmethod
+    def delay_template(cls, delay: int) -> dict:
+        return {"name": cls.delay_name, "suspend": {"duration": str(delay)}}
+
+
 class ArgoCronWorkflow(ArgoObject):
     kind = 'CronWorkflow'
 
     def __init__(self, namespace: str, name, schedule: str, entrypoint: str, templates: List[Resource],
-                 spec: dict = None, workflow_spec: dict = None):
+                 spec: dict = None, workflow_spec: dict = None, index: int = 0, concurrency_policy: str = None,
+                 starting_deadline: int = None, jitter: int = 0):
         super(ArgoCronWorkflow, self).__init__(namespace=namespace, name=name)
         self.name = name
+        # position in the schedule list, every schedule gets its own object
+        self.index = index
         self.schedule = schedule
         self.entrypoint = entrypoint
         self.templates = templates
         self.spec = spec or {}
         self.workflow_spec = workflow_spec or {}
+        self.concurrency_policy = concurrency_policy
+        self.starting_deadline = starting_deadline
+        # window in seconds the start is spread over
+        self.jitter = jitter
 
     def get_obj_name(self):
-        return f"{self.name}-cwf"
+        return f"{self.name}-cwf" if not self.index else f"{self.name}-cwf-{self.index}"
+
+    def get_jitter(self) -> tuple:
+        # never longer than the time between two runs, or delayed runs would overlap the next ones
+        window = min(self.jitter, cron_interval(self.schedule))
+        offset = jitter_offset(f"{self.namespace}/{self.get_obj_name()}", window)
+        return shift_cron(self.schedule, offset)
 
     def get_spec(self):
-        return {
-            "schedule": self.schedule,
+        schedule, delay = self.get_jitter()
+        entrypoint = self.entrypoint
+        templates = [t.to_dict() for t in self.templates]
+        if delay:
+            wrapper = JitterWorkflowTemplates(delay, jobs_template=self.entrypoint)
+            if {wrapper.name, wrapper.delay_name} & {t['name'] for t in templates}:
+                raise kopf.PermanentError(f"{wrapper.name} and {wrapper.delay_name} are reserved template names")
+            templates.extend([wrapper.to_dict(), wrapper.delay_template(delay)])
+            entrypoint = wrapper.name
+        spec = {
+            "schedule": schedule,
             "workflowSpec": {
-                "entrypoint": self.entrypoint,
-                "templates": [t.to_dict() for t in self.templates],
+                "entrypoint": entrypoint,
+                "templates": templates,
                 **self.workflow_spec
             },
-            **self.spec
         }
+        if self.concurrency_policy:
+            spec['concurrencyPolicy'] = self.concurrency_policy
+        if self.starting_deadline is not None:
+            spec['startingDeadlineSeconds'] = self.starting_deadline
+        spec.update(self.spec)
+        return spec
 
     @classmethod
     def from_flow(cls, namespace: str, name: str, schedule: str, jobs: dict, flow_info: FlowInfo,
-                  workflow_spec: dict = {},
+                  workflow_spec: dict = None,
                   **kwargs):
+        workflow_spec = dict(workflow_spec or {})
         print("flow_info_secrets", flow_info.secrets)
-        if flow_info.secrets:
-            if flow_info.secrets.get('provider') == 'kubernetes':
-                workflow_spec['volumes'] = [
-                    {"name": "secrets", "secret": {"secretName": flow_info.secrets.get('name')}}
-                ]
+        volumes = get_workflow_volumes(flow_info)
+        if volumes:
+            workflow_spec['volumes'] = volumes
         print(workflow_spec)
         return cls(namespace, name, schedule, **JobWorkflowTemplate.from_flow_jobs(jobs=jobs, flow_info=flow_info),
                    workflow_spec=workflow_spec,
@@ -375,21 +893,28 @@ class KubeActionObject(CustomObject):
 class KubeActionEvent(KubeActionObject):
     kind = 'Event'
 
-    def __init__(self, namespace: str, name, event_type='', event_data=None, jobs: list = None, metadata: dict = {}):
+    def __init__(self, namespace: str, name, event_type='', event_data=None, jobs: list = None, metadata: dict = {},
+                 jobs_ref: str = None):
         super(KubeActionEvent, self).__init__(namespace)
         self.name = name
         self.event_type = event_type
         self.event_data = event_data
         self.metadata = metadata
         self.jobs = jobs or []
+        # JobPayload config map holding the jobs
+        self.jobs_ref = jobs_ref
 
     def get_obj_name(self):
         return f"{self.name}-{self.event_type}"
 
     def get_spec(self):
-        return {
+        spec = {
             "type": self.event_type,
             "data": self.event_data,
             "jobs": self.jobs,
             "metadata": self.metadata,
         }
+        if self.jobs_ref:
+            spec['jobs'] = {}
+            spec['jobs_ref'] = self.jobs_ref
+        return spec
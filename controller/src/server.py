@@ -1,3 +1,5 @@
+import asyncio
+import json
 import logging
 import os
 import sys
@@ -14,21 +16,24 @@ sys.path.append(os.path.dirname(__file__))
 
 try:
     from client_helper import ArgoCronWorkflowAPI, KubeActionEventAPI, ArgoEventSourceAPI, ArgoSensorsAPI, \
-        ArgoGatewayAPI
+        ArgoGatewayAPI, ConfigMapAPI, run_async
     from schema import KubeActionEvent, ArgoCronWorkflow, FlowInfo, ArgoWebHookEventSource, ArgoWebHookGateway, \
-        ArgoWebHookSensor
+        ArgoWebHookSensor, ArgoSharedWebHookGateway, JobPayload, SHARED_WEBHOOK_NAME, WEBHOOK_ROUTES, critical_path, \
+        get_kubeaction_api, get_schedule_options, get_shared_webhook_namespace, get_shared_webhook_port, \
+        webhook_route_key
 except Exception as e:
     from .client_helper import ArgoCronWorkflowAPI, KubeActionEventAPI, ArgoEventSourceAPI, ArgoSensorsAPI, \
-        ArgoGatewayAPI
+        ArgoGatewayAPI, ConfigMapAPI, run_async
     from .schema import KubeActionEvent, ArgoCronWorkflow, FlowInfo, ArgoWebHookEventSource, ArgoWebHookGateway, \
-        ArgoWebHookSensor
+        ArgoWebHookSensor, ArgoSharedWebHookGateway, JobPayload, SHARED_WEBHOOK_NAME, WEBHOOK_ROUTES, critical_path, \
+        get_kubeaction_api, get_schedule_options, get_shared_webhook_namespace, get_shared_webhook_port, \
+        webhook_route_key
 
 home = str(Path.home())
 load_dotenv(verbose=True)
 BASE_DIR = os.path.dirname(__file__)
 print(os.environ.get('API_SERVICE'), os.environ.get('API_NAMESPACE'))
-KUBEACTION_API = os.environ.get('KUBEACTION_API') \
-                 or f"http://{os.environ.get('API_SERVICE')}.{os.environ.get('API_NAMESPACE')}.svc.cluster.local:{os.environ.get('API_PORT')}/events"
+KUBEACTION_API = get_kubeaction_api()
 
 
 # https://github.com/zalando-incubator/kopf/issues/292#issuecomment-600672405
@@ -69,8 +74,25 @@ def configure(logger, settings: kopf.OperatorSettings, **_):
     settings.posting.level = logging.DEBUG
 
 
+async def reconcile_children(api, owner: str, bodies: list, logger) -> dict:
+    # render -> apply by spec hash -> delete what is no longer rendered, safe to run on every resume
+    results = await asyncio.gather(*[api.apply(body) for body in bodies])
+    summary = {"created": 0, "replaced": 0, "unchanged": 0}
+    for obj, action in results:
+        summary[action] += 1
+        if action != 'unchanged':
+            logger.info(f"{action} {obj['kind']} {obj['metadata']['name']}")
+    deleted = await api.prune(owner, {body['metadata']['name'] for body in bodies})
+    for name in deleted:
+        logger.info(f"deleted {name}")
+    summary['deleted'] = len(deleted)
+    return summary
+
+
+@kopf.on.resume('kubeaction.spaceone.dev', 'v1alpha1', 'flows')
+@kopf.on.update('kubeaction.spaceone.dev', 'v1alpha1', 'flows')
 @kopf.on.create('kubeaction.spaceone.dev', 'v1alpha1', 'flows')
-def create_flows(body, spec, name, namespace, logger, **kwargs):
+async def create_flows(body, spec, name, namespace, logger, **kwargs):
     events = spec.get('events')
     jobs = spec.get('jobs')
     metadata = spec.get('metadata', {})
@@ -79,38 +101,56 @@ def create_flows(body, spec, name, namespace, logger, **kwargs):
         raise kopf.PermanentError("event(on) must be set")
     if not jobs or len(jobs) < 1:
         raise kopf.PermanentError("must set more than one job")
+    path = critical_path(jobs)
+
+    jobs_ref = None
+    if JobPayload.enabled():
+        payload = JobPayload(namespace, name, jobs)
+        payload_body = payload.to_dict()
+        kopf.adopt(payload_body)
+        if await run_async(ConfigMapAPI(namespace).create, body=payload_body):
+            logger.info(f"created job payload {payload.name}")
+        jobs_ref = payload.name
 
-    api = KubeActionEventAPI(namespace)
-    for k, v in events.items():
-        body = KubeActionEvent(namespace, name, event_type=k, event_data=v, jobs=jobs, metadata=metadata).to_dict()
-        pprint(body)
-        obj = api.create(body=body)
-        pprint(obj)
-        logger.info('create event', obj)
+    bodies = [
+        KubeActionEvent(namespace, name, event_type=k, event_data=v, jobs=jobs, metadata=metadata,
+                        jobs_ref=jobs_ref).to_dict(owner=name)
+        for k, v in events.items()
+    ]
+    summary = await reconcile_children(KubeActionEventAPI(namespace).to_async(), name, bodies, logger)
+
+    # saved to status.create_flows
+    return {
+        "jobs": len(jobs),
+        "critical_path": path,
+        "critical_path_length": len(path),
+        "events": summary,
+    }
 
 
+@kopf.on.resume('kubeaction.spaceone.dev', 'v1alpha1', 'events')
+@kopf.on.update('kubeaction.spaceone.dev', 'v1alpha1', 'events')
 @kopf.on.create('kubeaction.spaceone.dev', 'v1alpha1', 'events')
-def create_events(body, spec, name, namespace, logger, **kwargs):
-    pprint(body)
+async def create_events(body, spec, name, namespace, logger, **kwargs):
     event_type = spec.get('type')
     jobs = spec.get('jobs')
+    jobs_ref = spec.get('jobs_ref')
+    if jobs_ref:
+        jobs = JobPayload.load(await run_async(ConfigMapAPI(namespace).read_data, name=jobs_ref))
 
     metadata = spec.get('metadata', {})
-    print(f"{metadata=}")
-    flow_info = FlowInfo(
-        name=name,
-        repo=metadata.get('repository', ''),
-        github_token=metadata.get('github_token'),
-        secrets=metadata.get('secrets'),
-    )
-    print(f"{flow_info.repo=}")
+    flow_info = FlowInfo.from_metadata(name, metadata, jobs_configmap=jobs_ref)
+    bodies = []
     if event_type == 'schedule':
         data = spec.get('data', [])
-        for s in data:
+        for i, s in enumerate(data):
             cron = s.get('cron')
             if cron:
-                wf = ArgoCronWorkflow.from_flow(namespace, name, cron, jobs, flow_info=flow_info)
-                ArgoCronWorkflowAPI(namespace).create(body=wf.to_dict())
+                wf = ArgoCronWorkflow.from_flow(namespace, name, cron, jobs, flow_info=flow_info, index=i,
+                                                **get_schedule_options(s))
+                bodies.append(wf.to_dict(owner=name))
+    # also removes cron workflows when the event stops being a schedule
+    return await reconcile_children(ArgoCronWorkflowAPI(namespace).to_async(), name, bodies, logger)
 
 
 @kopf.on.create('kubeaction.spaceone.dev', 'v1alpha1', 'tasks')
@@ -153,6 +193,97 @@ def make_trigger_template(url, event_type_name, dependency_names: List[str]):
     }
 
 
+def is_shared_webhook(spec: dict) -> bool:
+    return (spec.get('mode') or os.environ.get('WEBHOOK_MODE', 'dedicated')) == 'shared'
+
+
+def get_webhook_routes(namespace: str, name: str, spec: dict) -> dict:
+    # route key -> webhook entry of the shared event source, every route is served on the shared port
+    port = f"{get_shared_webhook_port()}"
+    return {
+        webhook_route_key(namespace, name, k): {
+            "port": port,
+            "endpoint": f"/{namespace}/{name}{v.get('endpoint') or '/' + k}",
+            "method": v.get('method', 'POST'),
+        }
+        for k, v in (spec.get('events') or {}).items()
+    }
+
+
+def update_shared_webhook(namespace: str, name: str, event_type_name: str, routes: dict, logger) -> dict:
+    # only the routes of this EventType are touched, other EventTypes patch the same objects
+    shared_namespace = get_shared_webhook_namespace()
+    routes_api = ConfigMapAPI(shared_namespace)
+    try:
+        current = routes_api.read_data(WEBHOOK_ROUTES)
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+        current = {}
+    prefix = webhook_route_key(namespace, name, '')
+    stale = [k for k in current if k.startswith(prefix) and k not in routes]
+    if not routes and not stale:
+        # dedicated EventType with nothing left in the shared objects
+        return {"mode": "shared", "routes": 0, "removed": 0}
+
+    evs_api = ArgoEventSourceAPI(shared_namespace)
+    webhook = {**routes, **{k: None for k in stale}}
+    try:
+        evs_api.patch(name=SHARED_WEBHOOK_NAME, body={"spec": {"webhook": webhook}})
+    except kubernetes.client.rest.ApiException as e:
+        if e.status != 404:
+            raise
+        if routes:
+            evs_api.create(body=ArgoWebHookEventSource(shared_namespace, SHARED_WEBHOOK_NAME, routes).to_dict(
+                adopt=False))
+    if routes:
+        gateway = ArgoSharedWebHookGateway(shared_namespace, SHARED_WEBHOOK_NAME, get_shared_webhook_port(),
+                                           replica=int(os.environ.get('SHARED_WEBHOOK_REPLICA', '1')))
+        ArgoGatewayAPI(shared_namespace).apply(gateway.to_dict(adopt=False))
+
+    route_data = {
+        k: json.dumps({"event_type_name": event_type_name, "namespace": namespace, "event_type": name})
+        for k in routes
+    }
+    route_data.update({k: None for k in stale})
+    routes_api.patch_data(WEBHOOK_ROUTES, route_data)
+    for k, v in routes.items():
+        logger.info(f"route {v['endpoint']} -> {event_type_name}")
+    return {"mode": "shared", "routes": len(routes), "removed": len(stale)}
+
+
+def delete_dedicated_webhook(namespace: str, name: str, uid: str, logger) -> list:
+    # objects of the dedicated mode left after switching to shared, only the ones owned by this EventType
+    deleted = []
+    for api in (ArgoSensorsAPI(namespace), ArgoGatewayAPI(namespace), ArgoEventSourceAPI(namespace)):
+        try:
+            obj = api.get(name=name)
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+            continue
+        if not any(ref.get('uid') == uid for ref in obj['metadata'].get('ownerReferences', [])):
+            continue
+        try:
+            api.delete(name=name, body={})
+        except kubernetes.client.rest.ApiException as e:
+            if e.status != 404:
+                raise
+        logger.info(f"{obj['kind']} {name} deleted, {name} uses the shared webhook")
+        deleted.append(obj['kind'])
+    return deleted
+
+
+@kopf.on.delete('kubeaction.spaceone.dev', 'v1alpha1', 'eventtypes')
+def delete_event_types(spec, name, namespace, logger, **kwargs):
+    # dedicated objects are removed by their owner reference, shared routes are removed in any mode because the
+    # mode may have been switched since the last reconcile
+    if spec.get('type') == 'webhook':
+        update_shared_webhook(namespace, name, spec.get('event_type_name'), {}, logger)
+
+
+@kopf.on.resume('kubeaction.spaceone.dev', 'v1alpha1', 'eventtypes')
+@kopf.on.update('kubeaction.spaceone.dev', 'v1alpha1', 'eventtypes')
 @kopf.on.create('kubeaction.spaceone.dev', 'v1alpha1', 'eventtypes')
 def create_event_types(body, spec, name, namespace, logger, **kwargs):
     logger.info(f"{body}")
@@ -160,7 +291,14 @@ def create_event_types(body, spec, name, namespace, logger, **kwargs):
     event_type = spec.get('type')
     event_type_name = spec.get('event_type_name')
 
+    if event_type == 'webhook' and is_shared_webhook(spec):
+        result = update_shared_webhook(namespace, name, event_type_name, get_webhook_routes(namespace, name, spec),
+                                       logger)
+        result['deleted'] = delete_dedicated_webhook(namespace, name, body['metadata'].get('uid'), logger)
+        return result
     if event_type == 'webhook':
+        # routes left in the shared objects when this EventType used the shared mode before
+        update_shared_webhook(namespace, name, event_type_name, {}, logger)
         # webhook example
         # apiVersion: kubeaction.spaceone.dev/v1alpha1
         # kind: EventType
@@ -196,17 +334,19 @@ def create_event_types(body, spec, name, namespace, logger, **kwargs):
 
         evs = ArgoWebHookEventSource(namespace, name, events)
         evs_obj = evs.to_dict()
-        ArgoEventSourceAPI(namespace).create(body=evs_obj)
+        _, action = ArgoEventSourceAPI(namespace).apply(evs_obj)
         logger.info(evs_obj)
-        kopf.info(evs_obj, reason='Created', message='Gateway created')
+        if action != 'unchanged':
+            kopf.info(evs_obj, reason=action.capitalize(), message=f'EventSource {action}')
 
         ga = ArgoWebHookGateway(namespace, name, service_ports, sensor_port,
                                 replica=spec.get('gateway_replica'))
         ga_obj = ga.to_dict()
         pprint(ga_obj)
-        ArgoGatewayAPI(namespace).create(body=ga_obj)
+        _, action = ArgoGatewayAPI(namespace).apply(ga_obj)
         logger.info(ga_obj)
-        kopf.info(ga_obj, reason='Created', message='Gateway created')
+        if action != 'unchanged':
+            kopf.info(ga_obj, reason=action.capitalize(), message=f'Gateway {action}')
 
         sensor = ArgoWebHookSensor(
             namespace, name, event_names=event_names, sensor_port=sensor_port,
@@ -214,5 +354,6 @@ def create_event_types(body, spec, name, namespace, logger, **kwargs):
         )
         sensor_obj = sensor.to_dict()
         logger.info(sensor_obj)
-        ArgoSensorsAPI(namespace).create(body=sensor_obj)
-        kopf.info(sensor_obj, reason='Created', message='Sensor created')
+        _, action = ArgoSensorsAPI(namespace).apply(sensor_obj)
+        if action != 'unchanged':
+            kopf.info(sensor_obj, reason=action.capitalize(), message=f'Sensor {action}')
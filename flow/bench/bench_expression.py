@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+from time import perf_counter
+
+from jinja2 import Template
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from expression import LazyContext, compile_expression, compile_template, render_template
+
+TEMPLATES = [
+    "${{ github.repository }}",
+    "https://root:${{ secrets.password }}@example.com/{i}.git",
+    "${{ steps.build.outputs.version }}-{i}",
+    "release ${{ github.ref }} by ${{ github.repository_owner }}",
+    "${{ secrets.SLACK_WEBHOOK }}",
+]
+
+
+def make_values(n: int, distinct: int) -> list:
+    return [TEMPLATES[i % len(TEMPLATES)].replace('{i}', f'{i % distinct}') for i in range(n)]
+
+
+def make_ctx() -> dict:
+    return {
+        'github': {'repository': 'wesky93/KubeAction', 'repository_owner': 'wesky93', 'ref': 'refs/heads/master'},
+        'steps': {'build': {'outputs': {'version': '1.0.0'}}},
+        'secrets': {'password': 'p', 'SLACK_WEBHOOK': 'https://hooks.slack.com/x'},
+    }
+
+
+def jinja_render(values: list, ctx: dict):
+    # the previous template_render: a new jinja2.Template for every value
+    for v in values:
+        Template(v.replace('${{', '{{')).render(**ctx)
+
+
+def expression_render(values: list, ctx: dict):
+    context = LazyContext(ctx)
+    for v in values:
+        render_template(v, context)
+
+
+def bench(fn, values, ctx, repeat):
+    best = None
+    for _ in range(repeat):
+        start = perf_counter()
+        fn(values, ctx)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='compare jinja2 and compiled expression template rendering')
+    parser.add_argument('-n', type=int, default=5000, help='number of templated values')
+    parser.add_argument('--distinct', type=int, default=100, help='number of distinct values per template')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    values = make_values(args.n, args.distinct)
+    ctx = make_ctx()
+    compile_expression.cache_clear()
+    compile_template.cache_clear()
+    cold = bench(expression_render, values, ctx, 1)
+    warm = bench(expression_render, values, ctx, args.repeat)
+    jinja = bench(jinja_render, values, ctx, args.repeat)
+    print(f'values={args.n} distinct={len(set(values))}')
+    print(f'jinja2           {jinja * 1000:9.2f} ms')
+    print(f'expression cold  {cold * 1000:9.2f} ms')
+    print(f'expression warm  {warm * 1000:9.2f} ms')
+    print(f'template cache   {compile_template.cache_info()}')
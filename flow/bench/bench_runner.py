@@ -0,0 +1,184 @@
+import argparse
+import contextlib
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import sleep
+
+import docker
+import yaml
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import docker_helper
+from action_cache import ActionCache
+from job import Job
+from timing import Timer
+
+ACTION_IMAGE = 'docker://alpine:3.12'
+
+
+class FakeImage:
+    def __init__(self, ref: str):
+        self.id = f'sha256:{abs(hash(ref)):064x}'[:71]
+        self.attrs = {'Size': 5 * 1024 * 1024}
+
+
+class FakeImages:
+    # images.get/pull of docker-py, present after the first pull
+    def __init__(self, pull_delay: float, present: bool):
+        self.pull_delay = pull_delay
+        self.present = set()
+        self.all_present = present
+
+    def get(self, ref: str):
+        if self.all_present or ref in self.present:
+            return FakeImage(ref)
+        raise docker.errors.ImageNotFound(ref)
+
+    def pull(self, name: str, tag: str = 'latest'):
+        sleep(self.pull_delay)
+        ref = f'{name}:{tag}'
+        self.present.add(ref)
+        return FakeImage(ref)
+
+
+class FakeContainer:
+    short_id = 'bench'
+
+    def __init__(self, run_delay: float):
+        self.run_delay = run_delay
+
+    def start(self):
+        pass
+
+    def logs(self, stream=True, follow=True):
+        yield b'hello from fake container\n'
+        yield b'::set-output name=result::ok\n'
+
+    def wait(self, timeout=None):
+        sleep(self.run_delay)
+        return {'StatusCode': 0}
+
+    def kill(self):
+        pass
+
+    def remove(self, force=False):
+        pass
+
+
+class FakeContainers:
+    def __init__(self, run_delay: float):
+        self.run_delay = run_delay
+
+    def create(self, image, command, **kwargs):
+        return FakeContainer(self.run_delay)
+
+
+class FakeDocker:
+    def __init__(self, pull_delay: float = 0.0, run_delay: float = 0.0, present: bool = False):
+        self.images = FakeImages(pull_delay, present)
+        self.containers = FakeContainers(run_delay)
+
+
+def git(*args, cwd=None):
+    subprocess.run(['git', *args], cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def make_github(root: str, n_actions: int) -> str:
+    # <root>/bench/action-<i> bare repos served as file://<root>/bench/action-<i>
+    for i in range(n_actions):
+        work = os.path.join(root, 'work', f'action-{i}')
+        os.makedirs(work)
+        git('init', '-q', cwd=work)
+        git('checkout', '-q', '-b', 'master', cwd=work)
+        with open(os.path.join(work, 'action.yml'), 'w') as f:
+            yaml.dump({
+                'name': f'action {i}',
+                'inputs': {'greeting': {'default': 'hello'}},
+                'runs': {'using': 'docker', 'image': ACTION_IMAGE},
+            }, f)
+        with open(os.path.join(work, 'entrypoint.sh'), 'w') as f:
+            f.write('#!/bin/sh\necho "$INPUT_GREETING"\n')
+        git('add', '.', cwd=work)
+        git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost', 'commit', '-q', '-m', 'action', cwd=work)
+        git('clone', '-q', '--bare', work, os.path.join(root, 'bench', f'action-{i}'))
+    return f'file://{root}'
+
+
+def make_steps(n_run: int, n_uses: int, n_actions: int) -> list:
+    steps = []
+    for i in range(max(n_run, n_uses)):
+        if i < n_run:
+            steps.append({'id': f'run-{i}', 'run': f'echo "${{{{ github.repository }}}} {i}"',
+                          'env': {'STEP': f'{i}'}})
+        if i < n_uses:
+            steps.append({'uses': f'bench/action-{i % max(n_actions, 1)}@master',
+                          'with': {'greeting': '${{ github.repository }}'}})
+    return steps
+
+
+def run_job(steps: list, github_url: str, cache_dir: str = None) -> Timer:
+    timer = Timer(precision=6)
+    workspace = tempfile.TemporaryDirectory()
+    ctx = {'github': {'repository': 'wesky93/KubeAction', 'repository_owner': 'wesky93',
+                      'workspace': workspace.name, 'token': ''}}
+    action_cache = ActionCache(cache_dir) if cache_dir else None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        job = Job('bench', {'steps': steps}, workspace, ctx=ctx, action_cache=action_cache, timer=timer,
+                  github_url=github_url)
+        with timer.span('job'):
+            job.load()
+            job.start()
+    return timer
+
+
+def report(results: list, n_steps: int, as_json: bool):
+    phases = {}
+    for timer in results:
+        for name, duration in timer.phases().items():
+            phases.setdefault(name, []).append(duration)
+    rows = {name: {
+        'mean_ms': round(sum(v) / len(v) * 1000, 3),
+        'min_ms': round(min(v) * 1000, 3),
+        'per_step_ms': round(sum(v) / len(v) / max(n_steps, 1) * 1000, 3),
+    } for name, v in sorted(phases.items())}
+    if as_json:
+        print(json.dumps({'steps': n_steps, 'runs': len(results), 'phases': rows}))
+    else:
+        print(f"{'phase':<18} {'mean ms':>10} {'min ms':>10} {'per step ms':>12}")
+        for name, row in rows.items():
+            print(f"{name:<18} {row['mean_ms']:>10.3f} {row['min_ms']:>10.3f} {row['per_step_ms']:>12.3f}")
+    return rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='runner overhead with a local git server and a fake docker')
+    parser.add_argument('--run', type=int, default=20, help='number of run steps')
+    parser.add_argument('--uses', type=int, default=20, help='number of uses steps')
+    parser.add_argument('--actions', type=int, default=5, help='distinct actions used by the uses steps')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--action-cache', action='store_true', help='share an action cache between runs')
+    parser.add_argument('--image-present', action='store_true', help='images are present, no pull')
+    parser.add_argument('--pull-delay', type=float, default=0.0, help='seconds per fake image pull')
+    parser.add_argument('--run-delay', type=float, default=0.0, help='seconds per fake container run')
+    parser.add_argument('--json', action='store_true')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='exit 1 when the mean job time per step is over the budget')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        github_url = make_github(root, args.actions)
+        cache_dir = os.path.join(root, 'cache') if args.action_cache else None
+        steps = make_steps(args.run, args.uses, args.actions)
+        results = []
+        for _ in range(args.repeat):
+            # a new runner process per job, images are not present unless asked
+            docker_helper._client = FakeDocker(args.pull_delay, args.run_delay, args.image_present)
+            results.append(run_job(steps, github_url, cache_dir))
+        rows = report(results, len(steps), args.json)
+
+    if args.budget_ms is not None and rows['job']['per_step_ms'] > args.budget_ms:
+        print(f"job time per step {rows['job']['per_step_ms']}ms is over the budget {args.budget_ms}ms")
+        sys.exit(1)
@@ -0,0 +1,184 @@
+import fcntl
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from os import path
+from time import time
+
+import git
+
+SHA_PATTERN = re.compile(r'^[0-9a-f]{40}$')
+
+
+def dir_size(p: str) -> int:
+    size = 0
+    for dirpath, _, filenames in os.walk(p):
+        for f in filenames:
+            fp = path.join(dirpath, f)
+            if not path.islink(fp):
+                size += path.getsize(fp)
+    return size
+
+
+def resolve_ref(url: str, ref: str) -> str:
+    # resolve branch or tag to commit sha without cloning
+    if SHA_PATTERN.match(ref):
+        return ref
+    out = git.cmd.Git().ls_remote(url, ref)
+    refs = {}
+    for line in out.splitlines():
+        sha, name = line.split('\t', 1)
+        refs[name] = sha
+    for name in [f'refs/heads/{ref}', f'refs/tags/{ref}^{{}}', f'refs/tags/{ref}']:
+        if name in refs:
+            return refs[name]
+    raise ValueError(f'can not resolve {ref} from {url}')
+
+
+def fetch_action(url: str, ref: str, dest: str) -> str:
+    # shallow fetch of a single ref, returns checked out commit sha
+    repo = git.Repo.init(dest)
+    repo.git.fetch('--depth', '1', url, ref)
+    repo.git.checkout('FETCH_HEAD')
+    return repo.head.commit.hexsha
+
+
+def link_tree(src: str, dest: str, hardlink=True):
+    def _copy(s, d):
+        if hardlink:
+            try:
+                os.link(s, d)
+                return d
+            except OSError:
+                pass
+        return shutil.copy2(s, d)
+
+    shutil.copytree(src, dest, symlinks=True, copy_function=_copy)
+
+
+class ActionCache:
+    # entry layout: <root>/<owner>/<repo>/<sha>/{tree,meta.json} and <sha>.lock beside it
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024, hardlink=True):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hardlink = hardlink
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self._stats_lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, name: str, sha: str) -> str:
+        return path.join(self.root, *name.split('/'), sha)
+
+    @contextmanager
+    def _lock(self, entry: str, blocking=True):
+        os.makedirs(path.dirname(entry), exist_ok=True)
+        with open(f'{entry}.lock', 'w') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _read_meta(entry: str) -> dict:
+        with open(path.join(entry, 'meta.json')) as f:
+            return json.load(f)
+
+    @staticmethod
+    def _write_meta(entry: str, meta: dict):
+        # replaced atomically, evict of other threads/pods reads it without the entry lock
+        tmp = path.join(entry, f'.meta.json.{os.getpid()}.{threading.get_ident()}')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp, path.join(entry, 'meta.json'))
+
+    def _fill(self, url: str, ref: str, sha: str, entry: str, dest: str) -> dict:
+        tmp = tempfile.mkdtemp(dir=path.dirname(entry), prefix='.fetch-')
+        try:
+            tree = path.join(tmp, 'tree')
+            try:
+                # the resolved commit, the branch may have moved since ls-remote
+                fetched = fetch_action(url, sha, tree)
+            except git.GitCommandError:
+                # server does not allow fetching a sha
+                shutil.rmtree(tree, ignore_errors=True)
+                fetched = fetch_action(url, ref, tree)
+            shutil.rmtree(path.join(tree, '.git'))
+            meta = {'url': url, 'ref': ref, 'sha': fetched, 'size': dir_size(tree), 'last_used': time()}
+            if fetched != sha:
+                # never store another commit under this sha, used once without caching
+                print(f'action {url}@{ref} moved to {fetched} while fetching, not cached')
+                link_tree(tree, dest, hardlink=False)
+                shutil.rmtree(tmp, ignore_errors=True)
+                return meta
+            self._write_meta(tmp, meta)
+            os.rename(tmp, entry)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        link_tree(path.join(entry, 'tree'), dest, hardlink=self.hardlink)
+        return meta
+
+    def checkout(self, url: str, name: str, ref: str, dest: str) -> str:
+        sha = resolve_ref(url, ref)
+        entry = self.entry_path(name, sha)
+        with self._lock(entry):
+            if path.isdir(entry):
+                meta = self._read_meta(entry)
+                meta['last_used'] = time()
+                self._write_meta(entry, meta)
+                with self._stats_lock:
+                    self.hits += 1
+                    self.bytes_saved += meta['size']
+                print(f'action cache hit {name}@{ref} ({sha})')
+                link_tree(path.join(entry, 'tree'), dest, hardlink=self.hardlink)
+            else:
+                meta = self._fill(url, ref, sha, entry, dest)
+                with self._stats_lock:
+                    self.misses += 1
+                print(f'action cache miss {name}@{ref} ({sha})')
+        self.evict()
+        return meta['sha']
+
+    def entries(self):
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # skip fetches in progress
+            dirnames[:] = [d for d in dirnames if not d.startswith('.fetch-')]
+            if 'meta.json' in filenames:
+                dirnames[:] = []
+                try:
+                    meta = self._read_meta(dirpath)
+                except FileNotFoundError:
+                    # evicted by another thread or pod since the walk
+                    continue
+                yield dirpath, meta
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[1]['last_used'])
+        total = sum(meta['size'] for _, meta in entries)
+        for entry, meta in entries:
+            if total <= self.max_bytes:
+                break
+            with self._lock(entry, blocking=False) as locked:
+                if not locked:
+                    continue
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= meta['size']
+                print(f'action cache evict {entry}')
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+        }
@@ -0,0 +1,166 @@
+import threading
+from concurrent.futures import Future
+from contextlib import ExitStack
+from time import time
+
+import docker
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+ALWAYS = 'Always'
+IF_NOT_PRESENT = 'IfNotPresent'
+NEVER = 'Never'
+
+_client = None
+_client_lock = threading.Lock()
+_pulls = {}
+_pulls_lock = threading.Lock()
+_stats = {'pulls': 0, 'present': 0, 'bytes_pulled': 0, 'bytes_saved': 0}
+
+
+def get_client() -> docker.DockerClient:
+    # one client per runner process, version negotiation only happens once
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = docker.from_env(version='auto')
+        return _client
+
+
+def parse_image(img: str):
+    # docker://alpine:3.8, docker://ghcr.io/owner/img:tag, owner/img@sha256:...
+    if img.startswith('docker://'):
+        img = img[len('docker://'):]
+    if '@' in img:
+        name, digest = img.split('@', 1)
+        return name, digest
+    name, tag = img, 'latest'
+    if ':' in img.split('/')[-1]:
+        name, tag = img.rsplit(':', 1)
+    return name, tag
+
+
+def image_ref(name: str, tag: str) -> str:
+    return f'{name}@{tag}' if tag.startswith('sha256:') else f'{name}:{tag}'
+
+
+def find_image(ref: str):
+    try:
+        return get_client().images.get(ref)
+    except docker.errors.ImageNotFound:
+        return None
+
+
+def _pull(name: str, tag: str, policy: str):
+    ref = image_ref(name, tag)
+    if policy != ALWAYS:
+        img = find_image(ref)
+        if img:
+            print(f'image {ref} already present')
+            with _pulls_lock:
+                _stats['present'] += 1
+                _stats['bytes_saved'] += img.attrs.get('Size', 0)
+            return img
+        if policy == NEVER:
+            raise ValueError(f'image {ref} is not present and pull policy is {NEVER}')
+    print(f'start download {name} with tag {tag}')
+    img = get_client().images.pull(name, tag=tag)
+    print(f'finish download {img}')
+    with _pulls_lock:
+        _stats['pulls'] += 1
+        _stats['bytes_pulled'] += img.attrs.get('Size', 0)
+    return img
+
+
+def default_policy(tag: str) -> str:
+    # same as kubernetes, latest moves so it is always pulled
+    return ALWAYS if tag == 'latest' else IF_NOT_PRESENT
+
+
+def image_stats() -> dict:
+    with _pulls_lock:
+        return dict(_stats)
+
+
+def download_docker_image(img: str, policy: str = None):
+    name, tag = parse_image(img)
+    policy = policy or default_policy(tag)
+    ref = image_ref(name, tag)
+    # single flight, concurrent callers for one image share a pull
+    with _pulls_lock:
+        fut = _pulls.get(ref)
+        owner = fut is None
+        if owner:
+            fut = Future()
+            _pulls[ref] = fut
+    if owner:
+        try:
+            fut.set_result(_pull(name, tag, policy))
+        except BaseException as e:
+            fut.set_exception(e)
+        finally:
+            with _pulls_lock:
+                del _pulls[ref]
+    return fut.result()
+
+
+def _follow_logs(container, output):
+    buf = b''
+    for chunk in container.logs(stream=True, follow=True):
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        for line in lines:
+            output.handle(line.decode('utf-8', errors='replace'))
+    if buf:
+        output.handle(buf.decode('utf-8', errors='replace'))
+
+
+def is_wait_timeout(e: Exception, timeout: float) -> bool:
+    # over the unix socket a read timeout comes as a ConnectionError wrapping urllib3's ReadTimeoutError
+    if timeout is None:
+        return False
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return any(isinstance(arg, ReadTimeoutError) for arg in e.args)
+
+
+def run_container(image: str, command, output, timeout: float = None, timings: dict = None, track=None,
+                  **kwargs) -> dict:
+    # create/start/run/teardown are measured separately to see where docker action overhead goes
+    client = get_client()
+    timings = {} if timings is None else timings
+    start = time()
+    container = client.containers.create(image, command, **kwargs)
+    timings['create'] = time() - start
+    try:
+        start = time()
+        container.start()
+        timings['start'] = time() - start
+
+        start = time()
+        logs = threading.Thread(target=_follow_logs, args=(container, output), daemon=True)
+        logs.start()
+        try:
+            with ExitStack() as stack:
+                if track:
+                    stack.enter_context(track(container.kill))
+                result = container.wait(timeout=timeout)
+        except (requests.exceptions.ReadTimeout, requests.exceptions.ConnectionError) as e:
+            if not is_wait_timeout(e, timeout):
+                # connection refused, daemon gone
+                raise
+            container.kill()
+            raise TimeoutError(f'container {container.short_id} did not finish in {timeout}s')
+        finally:
+            logs.join(5)
+            timings['run'] = time() - start
+    finally:
+        start = time()
+        container.remove(force=True)
+        timings['teardown'] = time() - start
+        print('container timings', {k: round(v, 3) for k, v in timings.items()})
+
+    status = result.get('StatusCode', 0)
+    if status != 0:
+        raise docker.errors.ContainerError(container, status, command, image, output.tail_text())
+    return timings
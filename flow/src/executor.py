@@ -0,0 +1,95 @@
+import os
+import re
+import signal
+import subprocess
+from contextlib import ExitStack
+from collections import deque
+from datetime import datetime
+from time import time
+
+# https://help.github.com/en/actions/reference/workflow-commands-for-github-actions
+COMMAND_PATTERN = re.compile(r'^::([\w-]+)(?: (.*?))?::(.*)$')
+ESCAPES = [('%0D', '\r'), ('%0A', '\n'), ('%3A', ':'), ('%2C', ','), ('%25', '%')]
+
+
+def unescape(value: str) -> str:
+    for k, v in ESCAPES:
+        value = value.replace(k, v)
+    return value
+
+
+def parse_command(line: str):
+    m = COMMAND_PATTERN.match(line)
+    if not m:
+        return None
+    name, raw_props, value = m.groups()
+    props = {}
+    for prop in (raw_props or '').split(','):
+        if '=' in prop:
+            k, v = prop.split('=', 1)
+            props[k.strip()] = unescape(v)
+    return name, props, unescape(value)
+
+
+class CommandOutput:
+    def __init__(self, masks: list = None, tail_size: int = 200, prefix: str = ''):
+        self.masks = [m for m in (masks or []) if m]
+        self.tail = deque(maxlen=tail_size)
+        self.outputs = {}
+        self.prefix = prefix
+
+    def mask(self, line: str) -> str:
+        for m in self.masks:
+            line = line.replace(m, '***')
+        return line
+
+    def write(self, line: str):
+        line = self.mask(line)
+        self.tail.append(line)
+        print(f"{datetime.utcnow().isoformat(timespec='milliseconds')}Z {self.prefix}{line}", flush=True)
+
+    def handle(self, line: str):
+        line = line.rstrip('\r\n')
+        cmd = parse_command(line)
+        if not cmd:
+            self.write(line)
+            return
+        name, props, value = cmd
+        if name == 'set-output':
+            self.outputs[props.get('name')] = value
+        elif name == 'add-mask':
+            self.masks.append(value)
+        elif name == 'debug':
+            self.write(f'##[debug]{value}')
+        else:
+            self.write(line)
+
+    def tail_text(self) -> str:
+        return '\n'.join(self.tail)
+
+
+def run_command(cmd, cwd: str, env: dict, output: CommandOutput, timings: dict = None, track=None):
+    # stream output line by line, only a bounded tail is kept in memory
+    # track(kill) registers the kill of a cancellable job, the command gets its own process group so children die too
+    timings = {} if timings is None else timings
+    start = time()
+    proc = subprocess.Popen(cmd,
+                            shell=True,
+                            cwd=cwd,
+                            env=env,
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            encoding='utf-8',
+                            errors='replace',
+                            start_new_session=track is not None)
+    timings['spawn'] = time() - start
+    start = time()
+    with proc, ExitStack() as stack:
+        if track:
+            stack.enter_context(track(lambda: os.killpg(proc.pid, signal.SIGKILL)))
+        for line in proc.stdout:
+            output.handle(line)
+    timings['run'] = time() - start
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd, output=output.tail_text())
+    return output
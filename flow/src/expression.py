@@ -0,0 +1,432 @@
+import json
+import math
+import re
+from collections.abc import Mapping
+from functools import lru_cache
+from os import environ
+
+# https://docs.github.com/en/actions/reference/context-and-expression-syntax-for-github-actions
+CACHE_SIZE = int(environ.get('KUBEACTION_EXPRESSION_CACHE_SIZE', '4096'))
+
+TOKEN_PATTERN = re.compile(r"""\s*(?:
+    (?P<number>-?(?:0x[0-9a-fA-F]+|[0-9]+(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?))
+   |(?P<string>'(?:[^']|'')*')
+   |(?P<op>&&|\|\||==|!=|<=|>=|[<>!()\[\].,*])
+   |(?P<ident>[A-Za-z_][A-Za-z0-9_-]*)
+)""", re.X)
+TEMPLATE_START = '${{'
+TEMPLATE_END = '}}'
+SPACE_PATTERN = re.compile(r'\s*')
+FORMAT_PATTERN = re.compile(r'\{\{|\}\}|\{(\d+)\}')
+
+
+class ExpressionError(ValueError):
+    pass
+
+
+class Filtered(list):
+    # result of a `.*` object filter, property access applies to every item
+    pass
+
+
+class LazyContext(Mapping):
+    # values given as callables are only built when an expression reads them
+    def __init__(self, values: dict):
+        self._values = dict(values)
+        self._resolved = {}
+
+    def __getitem__(self, key):
+        if key not in self._resolved:
+            value = self._values[key]
+            self._resolved[key] = value() if callable(value) else value
+        return self._resolved[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def truthy(v) -> bool:
+    if v is None or v is False or v == '':
+        return False
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return not (v == 0 or math.isnan(v))
+    return True
+
+
+def to_number(v):
+    if v is None:
+        return 0
+    if isinstance(v, bool):
+        return 1 if v else 0
+    if isinstance(v, (int, float)):
+        return v
+    if isinstance(v, str):
+        s = v.strip()
+        if not s:
+            return 0
+        try:
+            return int(s, 16) if s.lower().startswith('0x') else float(s)
+        except ValueError:
+            return math.nan
+    return math.nan
+
+
+def to_str(v) -> str:
+    if v is None:
+        return ''
+    if isinstance(v, bool):
+        return 'true' if v else 'false'
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if isinstance(v, (dict, list)):
+        return json.dumps(v)
+    return str(v)
+
+
+def _kind(v):
+    if v is None:
+        return 'null'
+    if isinstance(v, bool):
+        return 'bool'
+    if isinstance(v, (int, float)):
+        return 'number'
+    if isinstance(v, str):
+        return 'str'
+    return 'object'
+
+
+def equals(a, b) -> bool:
+    ka, kb = _kind(a), _kind(b)
+    if ka == kb:
+        if ka == 'str':
+            return a.casefold() == b.casefold()
+        if ka == 'object':
+            return a is b
+        return a == b
+    if 'object' in (ka, kb):
+        return False
+    return to_number(a) == to_number(b)
+
+
+def compare(a, b, op: str) -> bool:
+    if _kind(a) == 'str' and _kind(b) == 'str':
+        a, b = a.casefold(), b.casefold()
+    else:
+        a, b = to_number(a), to_number(b)
+    if op == '<':
+        return a < b
+    if op == '<=':
+        return a <= b
+    if op == '>':
+        return a > b
+    return a >= b
+
+
+def get_property(obj, key):
+    if isinstance(obj, Filtered):
+        result = Filtered()
+        for item in obj:
+            value = get_property(item, key)
+            if isinstance(value, Filtered):
+                result.extend(value)
+            elif value is not None:
+                result.append(value)
+        return result
+    if isinstance(obj, Mapping):
+        if isinstance(key, str):
+            if key in obj:
+                return obj[key]
+            # property names are case insensitive
+            for k in obj:
+                if isinstance(k, str) and k.casefold() == key.casefold():
+                    return obj[k]
+            return None
+        return None
+    if isinstance(obj, list):
+        n = to_number(key)
+        if isinstance(n, float) and (math.isnan(n) or not n.is_integer()):
+            return None
+        n = int(n)
+        return obj[n] if 0 <= n < len(obj) else None
+    return None
+
+
+def _format(fmt, *args):
+    def replace(m):
+        if m.group(0) == '{{':
+            return '{'
+        if m.group(0) == '}}':
+            return '}'
+        idx = int(m.group(1))
+        if idx >= len(args):
+            raise ExpressionError(f'format index {idx} is out of range')
+        return to_str(args[idx])
+
+    return FORMAT_PATTERN.sub(replace, to_str(fmt))
+
+
+def _contains(search, item):
+    if isinstance(search, list):
+        return any(equals(x, item) for x in search)
+    return to_str(item).casefold() in to_str(search).casefold()
+
+
+def _join(value, sep=','):
+    if isinstance(value, list):
+        return to_str(sep).join(to_str(v) for v in value)
+    return to_str(value)
+
+
+def _status(ctx):
+    job = ctx.get('job') if isinstance(ctx, Mapping) else None
+    return (job or {}).get('status', 'success')
+
+
+FUNCTIONS = {
+    'contains': _contains,
+    'startswith': lambda s, v: to_str(s).casefold().startswith(to_str(v).casefold()),
+    'endswith': lambda s, v: to_str(s).casefold().endswith(to_str(v).casefold()),
+    'format': _format,
+    'join': _join,
+    'tojson': lambda v: json.dumps(v, indent=2),
+    'fromjson': lambda v: json.loads(to_str(v)),
+}
+STATUS_FUNCTIONS = {
+    'success': lambda ctx: _status(ctx) == 'success',
+    'always': lambda ctx: True,
+    'failure': lambda ctx: _status(ctx) == 'failure',
+    'cancelled': lambda ctx: _status(ctx) == 'cancelled',
+}
+
+
+def tokenize(src: str) -> list:
+    tokens = []
+    pos = 0
+    src = src.rstrip()
+    while pos < len(src):
+        m = TOKEN_PATTERN.match(src, pos)
+        if not m or m.end() == pos:
+            raise ExpressionError(f'unexpected character at {pos} in {src!r}')
+        kind = m.lastgroup
+        tokens.append((kind, m.group(kind)))
+        pos = m.end()
+    return tokens
+
+
+class Parser:
+    # recursive descent parser, every node is compiled to a closure taking the context
+    def __init__(self, src: str):
+        self.src = src
+        self.tokens = tokenize(src)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def accept(self, value):
+        if self.peek()[1] == value and self.peek()[0] == 'op':
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, value):
+        if not self.accept(value):
+            raise ExpressionError(f'expected {value!r} in {self.src!r}')
+
+    def parse(self):
+        node = self.or_()
+        if self.pos != len(self.tokens):
+            raise ExpressionError(f'unexpected token {self.peek()[1]!r} in {self.src!r}')
+        return node
+
+    def or_(self):
+        left = self.and_()
+        while self.accept('||'):
+            right = self.and_()
+            left = _or(left, right)
+        return left
+
+    def and_(self):
+        left = self.equality()
+        while self.accept('&&'):
+            right = self.equality()
+            left = _and(left, right)
+        return left
+
+    def equality(self):
+        left = self.comparison()
+        while True:
+            if self.accept('=='):
+                right = self.comparison()
+                left = (lambda l, r: lambda c: equals(l(c), r(c)))(left, right)
+            elif self.accept('!='):
+                right = self.comparison()
+                left = (lambda l, r: lambda c: not equals(l(c), r(c)))(left, right)
+            else:
+                return left
+
+    def comparison(self):
+        left = self.unary()
+        while self.peek()[0] == 'op' and self.peek()[1] in ('<', '<=', '>', '>='):
+            op = self.peek()[1]
+            self.pos += 1
+            right = self.unary()
+            left = (lambda l, r, op: lambda c: compare(l(c), r(c), op))(left, right, op)
+        return left
+
+    def unary(self):
+        if self.accept('!'):
+            node = self.unary()
+            return lambda c: not truthy(node(c))
+        return self.postfix(self.primary())
+
+    def postfix(self, node):
+        while True:
+            if self.accept('.'):
+                if self.accept('*'):
+                    node = (lambda n: lambda c: _filter(n(c)))(node)
+                    continue
+                kind, name = self.peek()
+                if kind != 'ident':
+                    raise ExpressionError(f'expected property name in {self.src!r}')
+                self.pos += 1
+                node = (lambda n, k: lambda c: get_property(n(c), k))(node, name)
+            elif self.accept('['):
+                if self.accept('*'):
+                    self.expect(']')
+                    node = (lambda n: lambda c: _filter(n(c)))(node)
+                    continue
+                index = self.or_()
+                self.expect(']')
+                node = (lambda n, i: lambda c: get_property(n(c), i(c)))(node, index)
+            else:
+                return node
+
+    def primary(self):
+        kind, value = self.peek()
+        if kind is None:
+            raise ExpressionError(f'unexpected end of {self.src!r}')
+        self.pos += 1
+        if kind == 'number':
+            number = to_number(value)
+            return lambda c: number
+        if kind == 'string':
+            text = value[1:-1].replace("''", "'")
+            return lambda c: text
+        if kind == 'op' and value == '(':
+            node = self.or_()
+            self.expect(')')
+            return node
+        if kind == 'ident':
+            literal = value.lower()
+            if literal in ('true', 'false', 'null'):
+                const = {'true': True, 'false': False, 'null': None}[literal]
+                return lambda c: const
+            if self.accept('('):
+                return self.call(literal)
+            return lambda c: c.get(value) if isinstance(c, Mapping) else None
+        raise ExpressionError(f'unexpected token {value!r} in {self.src!r}')
+
+    def call(self, name):
+        args = []
+        if not self.accept(')'):
+            args.append(self.or_())
+            while self.accept(','):
+                args.append(self.or_())
+            self.expect(')')
+        if name in STATUS_FUNCTIONS:
+            fn = STATUS_FUNCTIONS[name]
+            return lambda c: fn(c)
+        if name not in FUNCTIONS:
+            raise ExpressionError(f'unknown function {name} in {self.src!r}')
+        fn = FUNCTIONS[name]
+        return lambda c: fn(*[a(c) for a in args])
+
+
+def _or(left, right):
+    def node(c):
+        value = left(c)
+        return value if truthy(value) else right(c)
+
+    return node
+
+
+def _and(left, right):
+    def node(c):
+        value = left(c)
+        return right(c) if truthy(value) else value
+
+    return node
+
+
+def _filter(value):
+    if isinstance(value, Filtered):
+        result = Filtered()
+        for v in value:
+            result.extend(_filter(v))
+        return result
+    if isinstance(value, Mapping):
+        return Filtered(value.values())
+    if isinstance(value, list):
+        return Filtered(value)
+    return Filtered()
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_expression(src: str):
+    return Parser(src).parse()
+
+
+def find_expressions(template: str):
+    # (start, end, expression) of every ${{ }}, the closing }} is found by tokens so '}}' in a string is kept
+    pos = template.find(TEMPLATE_START)
+    while pos != -1:
+        i = pos + len(TEMPLATE_START)
+        while True:
+            i = SPACE_PATTERN.match(template, i).end()
+            if template.startswith(TEMPLATE_END, i) or i >= len(template):
+                break
+            m = TOKEN_PATTERN.match(template, i)
+            # unknown characters are left to the parser to report
+            i = m.end() if m and m.end() > i else i + 1
+        if i >= len(template):
+            # not closed, plain text
+            return
+        end = i + len(TEMPLATE_END)
+        yield pos, end, template[pos + len(TEMPLATE_START):i]
+        pos = template.find(TEMPLATE_START, end)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_template(template: str):
+    parts = []
+    pos = 0
+    for start, end, expression in find_expressions(template):
+        if start > pos:
+            parts.append(template[pos:start])
+        parts.append(compile_expression(expression.strip()))
+        pos = end
+    if pos < len(template):
+        parts.append(template[pos:])
+
+    def render(ctx):
+        return ''.join(p if isinstance(p, str) else to_str(p(ctx)) for p in parts)
+
+    return render
+
+
+def evaluate(expression: str, ctx: Mapping):
+    src = expression.strip()
+    found = next(find_expressions(src), None)
+    if found and found[0] == 0 and found[1] == len(src):
+        src = found[2].strip()
+    return compile_expression(src)(ctx)
+
+
+def render_template(template: str, ctx: Mapping) -> str:
+    if '${{' not in template:
+        return template
+    return compile_template(template)(ctx)
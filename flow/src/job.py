@@ -1,17 +1,24 @@
+import gzip
 import json
-import subprocess
 import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from dataclasses import dataclass
 from os import path, walk, environ
-from time import sleep
+from time import sleep, time
 from typing import ItemsView
 from urllib.parse import urlparse
 
-import docker
-import git
+import requests
 import yaml
-from jinja2 import Template
 
+from action_cache import ActionCache, fetch_action
+from docker_helper import download_docker_image, get_client, image_stats, run_container
+from executor import CommandOutput, run_command
+from expression import LazyContext, render_template
+from memo import StepMemo, snapshot
+from timing import Timer
 from utils import files_list
 
 
@@ -22,12 +29,12 @@ def get_yaml_file(filename):
 
 
 def template_render(_template: str, ctx: dict, secrets=None):
-    raw = _template.replace('${{', '{{')
-    temp = Template(raw)
-    context = ctx
-    if secrets:
-        pass
-    return temp.render(**context)
+    context = LazyContext({
+        **ctx,
+        'secrets': secrets or {},
+        'env': lambda: dict(environ),
+    })
+    return render_template(_template, context)
 
 
 def get_repo_name_version(p: str):
@@ -42,13 +49,16 @@ def get_repo_name_version(p: str):
 
 
 class BaseStep:
-    def __init__(self, job, working_dir: str, data: dict, secrets={}, ctx={}):
+    def __init__(self, job, working_dir: str, data: dict, secrets={}, ctx: dict = None):
         self._data = data
         self.job = job
         self.working_dir = working_dir
         self.secrets = secrets
-        self.ctx = ctx
+        # step outputs are written into ctx, never share a default
+        self.ctx = ctx if ctx is not None else {}
         self._env = None
+        self.index = None
+        self.output = CommandOutput(masks=list(secrets.values()), prefix=job.prefix)
 
     def id(self):
         return self._data.get('id')
@@ -57,9 +67,50 @@ class BaseStep:
         pass
 
     def start(self):
-        self.setup()
-        self.exec()
-        self.clean()
+        timer = self.job.timer
+        # opt in per step, a step without declared inputs may read anything in the workspace
+        opted = self._data.get('memo', 'memo-inputs' in self._data)
+        memo = self.job.memo if opted else None
+        parts = self.memo_parts() if memo else None
+        if parts:
+            with timer.span('memo_lookup', step=self.index):
+                key, hashes = memo.fingerprint(parts, self.working_dir, self._data.get('memo-inputs', []))
+                record = memo.lookup(f"{self.job.name}/{self._data.get('id') or self.index}", key, hashes)
+            if record:
+                with timer.span('memo_restore', step=self.index):
+                    outputs = memo.restore(record, self.working_dir)
+                if outputs is not None:
+                    self.output.outputs.update(outputs)
+                    self.set_outputs()
+                    return
+            before = snapshot(self.working_dir)
+        with timer.span('setup', step=self.index):
+            self.setup()
+        with timer.span('exec', step=self.index):
+            self.exec()
+        self.set_outputs()
+        if parts:
+            with timer.span('memo_save', step=self.index):
+                memo.save(key, before, self.working_dir, self.output.outputs)
+        with timer.span('clean', step=self.index):
+            self.clean()
+
+    def memo_parts(self):
+        # what the step result depends on besides memo-inputs, None when it can not be memoized
+        return None
+
+    def set_outputs(self):
+        step_id = self._data.get('id')
+        if step_id:
+            self.ctx.setdefault('steps', {})[step_id] = {'outputs': self.output.outputs}
+
+    def process_env(self, extra: dict = None) -> dict:
+        env = dict(environ)
+        if self.ctx.get('github'):
+            env.update(get_github_env(self.ctx['github']))
+        env.update({k: f'{v}' for k, v in self.env.items()})
+        env.update(extra or {})
+        return env
 
     def load(self):
         pass
@@ -71,13 +122,18 @@ class BaseStep:
         pass
 
     def render_value(self, value):
-        if type(value) == str and "{{" in value:
+        if type(value) == str and "${{" in value:
             return template_render(value, ctx=self.ctx, secrets=self.secrets)
         elif type(value) == bool:
             return 'true' if value else 'false'
         else:
             return value
 
+    @property
+    def timeout(self):
+        minutes = self._data.get('timeout-minutes')
+        return minutes * 60 if minutes else None
+
     @property
     def env(self):
         if not self._env:
@@ -97,24 +153,27 @@ class RunStep(BaseStep):
     def get_script(self):
         return template_render(self.run, self.ctx, secrets=self.secrets)
 
+    def memo_parts(self):
+        return {'run': self.get_script(), 'shell': 'bash', 'env': self.env}
+
     def exec(self):
         print(self.run)
-        sh = tempfile.NamedTemporaryFile()
-
-        with open(sh.name, 'w') as f:
-            f.write(self.get_script())
-
+        timer = self.job.timer
+        with timer.span('render', step=self.index):
+            script = self.get_script()
+        with timer.span('temp_file', step=self.index):
+            sh = tempfile.NamedTemporaryFile()
+            with open(sh.name, 'w') as f:
+                f.write(script)
+
+        timings = {}
         try:
-            out = subprocess.check_output(f'/bin/bash -e {sh.name}',
-                                          shell=True,
-                                          encoding='utf-8',
-                                          stderr=subprocess.STDOUT,
-                                          cwd=self.working_dir)
-        except subprocess.CalledProcessError as exc:
-            print(exc.output)
-            raise exc
-        print(out)
-        sh.close()
+            run_command(f'/bin/bash -e {sh.name}', self.working_dir, self.process_env(), self.output, timings,
+                        track=self.job.track)
+        finally:
+            sh.close()
+            for phase, duration in timings.items():
+                timer.add(f'command_{phase}', duration, step=self.index)
 
     def setup(self):
         pass
@@ -126,21 +185,6 @@ class RunStep(BaseStep):
         pass
 
 
-def download_docker_image(img: str):
-    tag = None
-    client = docker.from_env(version='auto')
-    url = urlparse(img)
-    info = url.path.split(":")
-    img_name = url.netloc + info[0]
-    if len(info) == 2:
-        tag = info[1]
-
-    print(f'start download {img_name} with tag {tag}')
-    img = client.images.pull(img_name, tag=tag)
-    print(f'finish download {img}')
-    return img
-
-
 def show_files(p):
     f = []
     for (dirpath, dirnames, filenames) in walk(p):
@@ -151,10 +195,10 @@ def show_files(p):
 
 
 class UsesStep(BaseStep):
-    def __init__(self, job, working_dir: str, data: dict, secrets={}, ctx={}):
+    def __init__(self, job, working_dir: str, data: dict, secrets={}, ctx: dict = None):
         super().__init__(job, working_dir, data, secrets=secrets, ctx=ctx)
         self.dir = None
-        self.repo = None
+        self.sha = None
         self.meta = None
         self.docker_img = None
 
@@ -197,44 +241,45 @@ class UsesStep(BaseStep):
             env[k] = v
         return {f"INPUT_{k.upper().replace('-', '_')}": self.render_value(v) for k, v in env.items()}
 
+    def memo_parts(self):
+        return {'uses': self.uses, 'sha': self.sha, 'inputs': self.get_inputs_env(), 'env': self.env}
+
     def exec(self):
         print(show_files(self.working_dir))
+        with self.job.timer.span('render', step=self.index):
+            inputs_env = self.get_inputs_env()
 
         if self.runtime == 'docker':
             print('run', f"{self.meta}")
-            client = docker.from_env(version='auto')
-            result = client.containers.run(
-                self.docker_img.id,
-                ['./entrypoint.sh'],
-                detach=True,
-                auto_remove=True,
-                working_dir='/github/workflow',
-                environment=self.env,
-                volumes={
-                    "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"},
-                    f"/{self.working_dir}": {"bind": "/github/workflow", "mode": "rw"}
-                }
-            )
+            timings = {}
             try:
-                print(result.logs())
-            except Exception as e:
-                print(e)
-            result.remove(force=True)
+                run_container(
+                    self.docker_img.id,
+                    ['./entrypoint.sh'],
+                    self.output,
+                    timeout=self.timeout,
+                    timings=timings,
+                    track=self.job.track,
+                    working_dir='/github/workflow',
+                    environment={**self.env, **inputs_env},
+                    volumes={
+                        "/var/run/docker.sock": {"bind": "/var/run/docker.sock", "mode": "rw"},
+                        f"/{self.working_dir}": {"bind": "/github/workflow", "mode": "rw"}
+                    }
+                )
+            finally:
+                for phase, duration in timings.items():
+                    self.job.timer.add(f'container_{phase}', duration, step=self.index)
         elif self.runtime == 'node12':
             print(show_files(self.path))
-            inputs = self.get_inputs_env().items()
-            exports = "; ".join([f"export {k}={v}" for k, v in inputs]) + "; " if inputs else ""
             entrypoint = path.join(self.path, self.main)
+            timings = {}
             try:
-                out = subprocess.check_output(f'{exports}node {entrypoint}',
-                                              shell=True,
-                                              encoding='utf-8',
-                                              stderr=subprocess.STDOUT,
-                                              cwd=self.working_dir)
-            except subprocess.CalledProcessError as exc:
-                print(exc.output)
-                raise exc
-            print(out)
+                run_command(f'node {entrypoint}', self.working_dir, self.process_env(inputs_env), self.output, timings,
+                            track=self.job.track)
+            finally:
+                for phase, duration in timings.items():
+                    self.job.timer.add(f'command_{phase}', duration, step=self.index)
         else:
             print(f'dose not support {self.runtime}')
 
@@ -242,68 +287,179 @@ class UsesStep(BaseStep):
         self.dir = self.uses.split('/')[-1]
         prefix = self.uses.split('/')[:-1]
         meta = get_repo_name_version(self.dir)
-        url = '/'.join(prefix + [meta['name']])
-        url = f'https://github.com/{url}'
+        name = '/'.join(prefix + [meta['name']])
+        url = f'{self.job.github_url}/{name}'
         branch = meta['version'] or 'master'
         print('start download git')
-        self.path = path.join(self.working_dir, meta['name'])
+        # owner is part of the path, foo/setup@v1 and bar/setup@v1 are different checkouts
+        self.path = path.join(self.working_dir, f"{name.replace('/', '_')}@{branch}")
         print(self.path, 'git pull path')
-        self.repo = git.Repo.clone_from(url, self.path, branch=branch)
-        print(f'finish {meta["name"]} git download')
+        self.sha = self.job.once(f'action {name}@{branch}', lambda: self._fetch(url, name, branch))
+        print(f'finish {meta["name"]} git download ({self.sha})')
         self.meta = self.find_action_meta()
         print(f"{self.meta}")
 
         # download docker image
         self._ready()
 
+    def _fetch(self, url, name, branch):
+        with self.job.timer.span('clone', step=self.index):
+            if self.job.action_cache:
+                return self.job.action_cache.checkout(url, name, branch, self.path)
+            return fetch_action(url, branch, self.path)
+
     def _ready(self):
         runs = self.meta.get('runs')
         print(f"{runs}")
         if runs.get('using') == 'docker':
             img = runs.get('image')
             if img:
-                self.docker_img = download_docker_image(img)
+                self.docker_img = self.job.once(f'image {img}', lambda: self._pull(img))
+
+    def _pull(self, img):
+        with self.job.timer.span('image_check', step=self.index):
+            return download_docker_image(img, self.job.image_pull_policy)
 
     def find_action_meta(self):
-        tree = self.repo.tree()
-        for blob in tree.blobs:
-            if blob.name == 'action.yml':
-                return get_yaml_file(blob.abspath)
+        for name in ['action.yml', 'action.yaml']:
+            filename = path.join(self.path, name)
+            if path.isfile(filename):
+                return get_yaml_file(filename)
 
 
-def get_steps(job, wdr, steps: list, secrets={}, ctx={}):
+def get_steps(job, wdr, steps: list, secrets={}, ctx: dict = None):
+    # steps of a job share one ctx, later steps read outputs of earlier ones
+    ctx = ctx if ctx is not None else {}
     result = []
     for step in steps:
         klass = RunStep
         if step.get('uses'):
             klass = UsesStep
         result.append(klass(job, wdr, step, secrets, ctx))
+        result[-1].index = len(result) - 1
 
     print(result)
     return result
 
 
+def _kill(kill):
+    try:
+        kill()
+    except Exception as e:
+        # already exited
+        print(f'fail to kill {e}')
+
+
 class Job():
     def __init__(self,
                  name: str,
                  data: dict,
                  workspace: tempfile.TemporaryDirectory = None,
                  secrets={},
-                 ctx: dict = {}
+                 ctx: dict = None,
+                 action_cache: ActionCache = None,
+                 load_concurrency: int = 4,
+                 overlap_load: bool = False,
+                 image_pull_policy: str = None,
+                 timer: Timer = None,
+                 github_url: str = 'https://github.com',
+                 memo: StepMemo = None,
+                 prefix: str = '',
                  ):
         self._data = data
         self.name = name
+        # output line prefix, jobs of a pack share the pod log
+        self.prefix = prefix
         self.workspace = workspace or tempfile.TemporaryDirectory()
+        self.action_cache = action_cache
+        self.load_concurrency = load_concurrency
+        self.overlap_load = overlap_load
+        self.image_pull_policy = image_pull_policy
+        self.timer = timer or Timer()
+        # actions are fetched from <github_url>/<owner>/<repo>
+        self.github_url = github_url.rstrip('/')
+        # incremental mode, unchanged steps are restored instead of executed
+        self.memo = memo
+        self._deps = {}
+        self._deps_lock = threading.Lock()
+        self._step_loads = []
+        # set by cancel, the running command or container is killed and no further step starts
+        self.cancelled = threading.Event()
+        self._running = set()
+        self._running_lock = threading.Lock()
         self.steps = get_steps(self, self.workspace.name, self._data.get('steps', []), secrets, ctx)
 
-    def load(self):
-        for step in self.steps:
+    def once(self, key: str, fn):
+        # fetch each dependency(action ref, docker image) only once per job
+        with self._deps_lock:
+            fut = self._deps.get(key)
+            owner = fut is None
+            if owner:
+                fut = Future()
+                self._deps[key] = fut
+        if owner:
+            start = time()
+            try:
+                with self.timer.span('load_dependency', dependency=key):
+                    fut.set_result(fn())
+            except BaseException as e:
+                fut.set_exception(e)
+            finally:
+                print(f'load {key} {time() - start:.2f}s')
+        return fut.result()
+
+    @contextmanager
+    def track(self, kill):
+        with self._running_lock:
+            self._running.add(kill)
+        if self.cancelled.is_set():
+            _kill(kill)
+        try:
+            yield
+        finally:
+            with self._running_lock:
+                self._running.discard(kill)
+
+    def cancel(self):
+        self.cancelled.set()
+        with self._running_lock:
+            kills = list(self._running)
+        for kill in kills:
+            _kill(kill)
+
+    def _load_step(self, step):
+        with self.timer.span('load', step=step.index):
             step.load()
 
+    def load(self):
+        pool = ThreadPoolExecutor(max_workers=self.load_concurrency)
+        self._step_loads = [pool.submit(self._load_step, step) for step in self.steps]
+        pool.shutdown(wait=False)
+        if not self.overlap_load:
+            self.wait_loaded()
+
+    def wait_loaded(self):
+        for fut in self._step_loads:
+            fut.result()
+        loads = [s for s in self.timer.spans if s['name'] in ('load', 'load_dependency')]
+        for span in sorted(loads, key=lambda s: s['duration'], reverse=True):
+            print(f"load timing {span.get('dependency', span.get('step'))} {span['duration']:.2f}s")
+
     def start(self):
-        for step in self.steps:
+        for idx, step in enumerate(self.steps):
+            if idx < len(self._step_loads):
+                # with overlap_load, later steps keep loading while earlier ones run
+                self._step_loads[idx].result()
+            if self.cancelled.is_set():
+                raise RuntimeError(f'job {self.name} was cancelled')
             step.start()
-        self.workspace.cleanup()
+        with self.timer.span('workspace_cleanup'):
+            self.workspace.cleanup()
+        if self.action_cache:
+            print('action cache', self.action_cache.stats())
+        if self.memo:
+            print('step memo', self.memo.stats())
+        print('docker images', image_stats())
 
 
 @dataclass
@@ -318,8 +474,35 @@ class KubeActionENV:
 
     @property
     def job(self):
+        path = environ.get('KUBEACTION_JOB_PATH')
+        if path:
+            # jobs of the flow mounted from a config map
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt') as f:
+                return json.load(f)[self.job_name]
         return json.loads(environ.get('KUBEACTION_JOB', ''))
 
+    @property
+    def pack(self):
+        # names of the jobs packed into this pod
+        return json.loads(environ.get('KUBEACTION_PACK') or '[]')
+
+    @property
+    def jobs(self):
+        # packed jobs by name, from the payload or KUBEACTION_JOB
+        path = environ.get('KUBEACTION_JOB_PATH')
+        if path:
+            opener = gzip.open if path.endswith('.gz') else open
+            with opener(path, 'rt') as f:
+                data = json.load(f)
+        else:
+            data = json.loads(environ.get('KUBEACTION_JOB', ''))
+        return {name: data[name] for name in self.pack}
+
+    @property
+    def matrix(self):
+        return json.loads(environ.get('KUBEACTION_MATRIX') or '{}')
+
     @property
     def repository(self):
         return environ.get('KUBEACTION_REPOSITORY')
@@ -328,19 +511,74 @@ class KubeActionENV:
     def github_token(self):
         return environ.get('KUBEACTION_GITHUB_TOKEN', '')
 
+    @property
+    def api(self):
+        # timing summary is posted to controller /events when set
+        return environ.get('KUBEACTION_API')
+
     @property
     def dind_mode(self):
         return environ.get('DIND_MODE', 'false') == 'true'
 
+    @property
+    def action_cache_dir(self):
+        return environ.get('KUBEACTION_ACTION_CACHE')
 
-def set_github_env(ctx: dict):
-    data = {
-        "GITHUB_REPOSITORY": ctx['repository'],
-        "GITHUB_WORKSPACE": ctx['workspace'],
-        "GITHUB_TOKEN": ctx['token']
+    @property
+    def action_cache_size(self):
+        # MiB
+        return int(environ.get('KUBEACTION_ACTION_CACHE_SIZE', '1024'))
+
+    @property
+    def load_concurrency(self):
+        return int(environ.get('KUBEACTION_LOAD_CONCURRENCY', '4'))
+
+    @property
+    def overlap_load(self):
+        return environ.get('KUBEACTION_LOAD_OVERLAP', 'false') == 'true'
+
+    @property
+    def image_pull_policy(self):
+        # Always, IfNotPresent or Never. by tag when not set, Always for latest and IfNotPresent for others
+        return environ.get('KUBEACTION_IMAGE_PULL_POLICY')
+
+    @property
+    def github_url(self):
+        return environ.get('KUBEACTION_GITHUB_URL', 'https://github.com')
+
+    @property
+    def incremental(self):
+        return environ.get('KUBEACTION_INCREMENTAL', 'false') == 'true'
+
+    @property
+    def incremental_explain(self):
+        return environ.get('KUBEACTION_INCREMENTAL_EXPLAIN', 'false') == 'true'
+
+    @property
+    def memo_dir(self):
+        return environ.get('KUBEACTION_MEMO_DIR', path.join(path.expanduser('~'), '.cache', 'kubeaction', 'memo'))
+
+    @property
+    def memo_size(self):
+        # MiB
+        return int(environ.get('KUBEACTION_MEMO_SIZE', '1024'))
+
+    @property
+    def action_cache_hardlink(self):
+        return environ.get('KUBEACTION_ACTION_CACHE_LINK', 'hardlink') == 'hardlink'
+
+
+def get_github_env(ctx: dict) -> dict:
+    return {
+        "GITHUB_REPOSITORY": ctx.get('repository', ''),
+        "GITHUB_WORKSPACE": ctx.get('workspace', ''),
+        "GITHUB_TOKEN": ctx.get('token', '')
 
     }
-    for k, v in data.items():
+
+
+def set_github_env(ctx: dict):
+    for k, v in get_github_env(ctx).items():
         environ[k] = v
 
 
@@ -362,6 +600,82 @@ def get_github_context(env: KubeActionENV, workspace: str):
     return ctx
 
 
+def report_timing(env: KubeActionENV, timer: Timer, job_name: str = None, status: str = None):
+    summary = {
+        "flow": env.flow_name,
+        "job": job_name or env.job_name,
+        **timer.summary(),
+    }
+    if status:
+        summary['status'] = status
+    print('kubeaction timing', json.dumps(summary))
+    if env.api:
+        try:
+            requests.post(env.api, json={"event_type_name": "kubeaction_timing", "data": summary}, timeout=5)
+        except requests.RequestException as e:
+            print(f'fail to report timing {e}')
+
+
+def wait_docker(timer: Timer, max_try: int = 10):
+    # dind sidecar starts with the job container
+    print('this is DinD Mode')
+    with timer.span('dind_wait'):
+        while True:
+            try:
+                client = get_client()
+                print('images', client.images.list())
+                print('docker load success')
+                return
+            except Exception as e:
+                max_try -= 1
+                print(f'fail to run docker {max_try} retry left')
+                if max_try == 0:
+                    raise e
+                sleep(2)
+
+
+def get_action_cache(env: KubeActionENV):
+    if not env.action_cache_dir:
+        return None
+    return ActionCache(env.action_cache_dir, max_bytes=env.action_cache_size * 1024 * 1024,
+                       hardlink=env.action_cache_hardlink)
+
+
+def get_memo(env: KubeActionENV):
+    if not env.incremental:
+        return None
+    return StepMemo(env.memo_dir, max_bytes=env.memo_size * 1024 * 1024, explain=env.incremental_explain)
+
+
+def run_pack(env: KubeActionENV, github: dict, secrets: dict, **job_kwargs) -> dict:
+    # packed jobs run at once, each with its own workspace, timer and status. one failure does not stop the others
+    jobs = env.jobs
+
+    def run_one(name: str) -> str:
+        timer = Timer()
+        workspace = tempfile.TemporaryDirectory()
+        ctx = {"github": {**github, "workspace": workspace.name, "job": name}, "matrix": {}}
+        status = 'failed'
+        try:
+            with timer.span('job'):
+                job = Job(name, jobs[name], workspace, ctx=ctx, secrets=secrets, timer=timer, prefix=f'[{name}] ',
+                          **job_kwargs)
+                job.load()
+                job.start()
+            status = 'succeeded'
+        except Exception as e:
+            print(f'[{name}] job failed {e}')
+        finally:
+            workspace.cleanup()
+            report_timing(env, timer, job_name=name, status=status)
+        return status
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        results = dict(zip(jobs, pool.map(run_one, jobs)))
+    print('kubeaction pack', json.dumps(results))
+    return results
+
+
 def load_secrets(mount_path='/secret/kubeaction'):
     _secrets = {}
     for f in files_list(mount_path):
@@ -373,34 +687,43 @@ def load_secrets(mount_path='/secret/kubeaction'):
 
 
 if __name__ == '__main__':
+    timer = Timer()
     # get secrets
-    secrets = load_secrets()
+    with timer.span('load_secrets'):
+        secrets = load_secrets()
     workspace = tempfile.TemporaryDirectory()
     kube_env = KubeActionENV()
     context = {
-        "github": get_github_context(kube_env, workspace.name)
+        "github": get_github_context(kube_env, workspace.name),
+        "matrix": kube_env.matrix,
     }
 
-    if kube_env.dind_mode:
-        print('this is DinD Mode')
-        load = False
-        max_try = 10
-        while not load:
-            try:
-                client = docker.from_env(version='auto')
-                print('images', client.images.list())
-                print('docker load success')
-                load = True
-            except Exception as e:
-                max_try -= 1
-                print(f'fail to run docker {max_try} retry left')
-                if max_try == 0:
-                    raise e
-                sleep(2)
-
-    job = Job(kube_env.job_name, kube_env.job, workspace, ctx=context, secrets=secrets)
-    job.load()
-    job.start()
+    failed = []
+    try:
+        if kube_env.dind_mode:
+            wait_docker(timer)
+        action_cache = get_action_cache(kube_env)
+        memo = get_memo(kube_env)
+
+        if kube_env.pack:
+            results = run_pack(kube_env, context['github'], secrets, action_cache=action_cache,
+                               load_concurrency=kube_env.load_concurrency, overlap_load=kube_env.overlap_load,
+                               image_pull_policy=kube_env.image_pull_policy, github_url=kube_env.github_url,
+                               memo=memo)
+            failed = [name for name, status in results.items() if status != 'succeeded']
+        else:
+            job = Job(kube_env.job_name, kube_env.job, workspace, ctx=context, secrets=secrets,
+                      action_cache=action_cache, load_concurrency=kube_env.load_concurrency,
+                      overlap_load=kube_env.overlap_load, image_pull_policy=kube_env.image_pull_policy, timer=timer,
+                      github_url=kube_env.github_url, memo=memo)
+            job.load()
+            job.start()
+    finally:
+        report_timing(kube_env, timer)
+    if failed:
+        # the pod fails when a packed job failed, statuses per job are in the log and timing reports
+        print(f"failed jobs {', '.join(failed)}")
+        raise SystemExit(1)
 
     # run job
     # export output
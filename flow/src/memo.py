@@ -0,0 +1,235 @@
+import fcntl
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import contextmanager, suppress
+from os import path
+from time import time
+
+
+def sha256_file(p: str) -> str:
+    h = hashlib.sha256()
+    with open(p, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def digest(value) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def snapshot(root: str) -> dict:
+    # relpath -> (size, mtime_ns), cheap enough to take before every memoized step
+    files = {}
+    for dirpath, _, filenames in os.walk(root):
+        for f in filenames:
+            fp = path.join(dirpath, f)
+            if path.islink(fp) or not path.isfile(fp):
+                continue
+            st = os.stat(fp)
+            files[path.relpath(fp, root)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def hash_inputs(root: str, patterns: list) -> dict:
+    # declared memo-inputs, globs relative to the workspace
+    result = {}
+    for pattern in patterns:
+        matches = sorted(glob.glob(path.join(root, pattern), recursive=True))
+        if not matches:
+            result[pattern] = 'missing'
+        for m in matches:
+            if path.isfile(m):
+                result[path.relpath(m, root)] = sha256_file(m)
+    return result
+
+
+def _write_json(p: str, data: dict):
+    tmp = f'{p}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, p)
+
+
+class StepMemo:
+    # step records keyed by fingerprint: workspace diff(blobs by sha256) + step outputs
+    # layout: <root>/blobs/<sha[:2]>/<sha>, <root>/steps/<key>.json, <root>/explain/<step>.json
+    def __init__(self, root: str, max_bytes: int = 1024 * 1024 * 1024, explain: bool = False):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.explain = explain
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        for d in ('blobs', 'steps', 'explain'):
+            os.makedirs(path.join(root, d), exist_ok=True)
+
+    def fingerprint(self, parts: dict, workspace: str, inputs: list) -> tuple:
+        # only hashes are kept, rendered scripts and env may contain secrets
+        hashes = {k: digest(v) for k, v in parts.items() if k != 'env'}
+        hashes.update({f'env {k}': digest(v) for k, v in (parts.get('env') or {}).items()})
+        hashes.update({f'input {k}': v for k, v in hash_inputs(workspace, inputs).items()})
+        return digest(hashes), hashes
+
+    def _record_path(self, key: str) -> str:
+        return path.join(self.root, 'steps', f'{key}.json')
+
+    def _blob_path(self, sha: str) -> str:
+        return path.join(self.root, 'blobs', sha[:2], sha)
+
+    @contextmanager
+    def _lock(self, shared=False):
+        # the root is shared by the jobs of a pack and by the runners of a pool.
+        # save and evict are exclusive, restoring only reads blobs
+        with open(path.join(self.root, 'memo.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def lookup(self, step_name: str, key: str, hashes: dict):
+        record_path = self._record_path(key)
+        record = None
+        if path.isfile(record_path):
+            with open(record_path) as f:
+                record = json.load(f)
+            if not all(path.isfile(self._blob_path(b['sha'])) for b in record['files'].values()):
+                record = None
+        with self._stats_lock:
+            if record:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if record:
+            record['last_used'] = time()
+            _write_json(record_path, record)
+        if self.explain:
+            print(f'memo {step_name}: {self.reason(step_name, hashes, record)}')
+        _write_json(self._explain_path(step_name), hashes)
+        return record
+
+    def _explain_path(self, step_name: str) -> str:
+        return path.join(self.root, 'explain', f'{digest(step_name)[:32]}.json')
+
+    def reason(self, step_name: str, hashes: dict, record) -> str:
+        if record:
+            return 'hit, fingerprint unchanged'
+        p = self._explain_path(step_name)
+        if not path.isfile(p):
+            return 'miss, no previous run'
+        with open(p) as f:
+            previous = json.load(f)
+        changed = sorted(k for k in set(previous) | set(hashes) if previous.get(k) != hashes.get(k))
+        if not changed:
+            return 'miss, previous record was evicted or failed'
+        return f"miss, changed: {', '.join(changed)}"
+
+    def restore(self, record: dict, workspace: str):
+        # None when an evict removed a blob after lookup, the step runs instead
+        with self._lock(shared=True):
+            if not all(path.isfile(self._blob_path(b['sha'])) for b in record['files'].values()):
+                with self._stats_lock:
+                    self.hits -= 1
+                    self.misses += 1
+                return None
+            return self._restore(record, workspace)
+
+    def _restore(self, record: dict, workspace: str) -> dict:
+        for rel, blob in record['files'].items():
+            dest = path.join(workspace, rel)
+            os.makedirs(path.dirname(dest), exist_ok=True)
+            # copied, later steps may modify the file
+            shutil.copyfile(self._blob_path(blob['sha']), dest)
+            os.chmod(dest, blob['mode'])
+        for rel in record['deleted']:
+            p = path.join(workspace, rel)
+            if path.isfile(p):
+                os.remove(p)
+        return record['outputs']
+
+    def save(self, key: str, before: dict, workspace: str, outputs: dict):
+        # blobs and their record are written before an evict can look for unreferenced blobs
+        with self._lock():
+            self._save(key, before, workspace, outputs)
+            self._evict()
+
+    def _save(self, key: str, before: dict, workspace: str, outputs: dict):
+        after = snapshot(workspace)
+        files = {}
+        for rel, stat in after.items():
+            if before.get(rel) == stat:
+                continue
+            src = path.join(workspace, rel)
+            sha = sha256_file(src)
+            blob = self._blob_path(sha)
+            if not path.isfile(blob):
+                os.makedirs(path.dirname(blob), exist_ok=True)
+                tmp = f'{blob}.{os.getpid()}.{threading.get_ident()}.tmp'
+                shutil.copyfile(src, tmp)
+                os.replace(tmp, blob)
+            files[rel] = {'sha': sha, 'mode': os.stat(src).st_mode & 0o7777, 'size': stat[0]}
+        record = {
+            'files': files,
+            'deleted': sorted(set(before) - set(after)),
+            'outputs': outputs,
+            'created': time(),
+            'last_used': time(),
+        }
+        _write_json(self._record_path(key), record)
+
+    def records(self):
+        steps = path.join(self.root, 'steps')
+        for name in os.listdir(steps):
+            if name.endswith('.json'):
+                p = path.join(steps, name)
+                try:
+                    with open(p) as f:
+                        yield p, json.load(f)
+                except (OSError, ValueError):
+                    continue
+
+    def evict(self):
+        with self._lock():
+            self._evict()
+
+    def _evict(self):
+        # drop least recently used records until the blobs they keep fit in max_bytes
+        started = time()
+        records = sorted(self.records(), key=lambda r: r[1]['last_used'])
+        refs = {}
+        sizes = {}
+        for _, record in records:
+            for b in record['files'].values():
+                refs[b['sha']] = refs.get(b['sha'], 0) + 1
+                sizes[b['sha']] = b['size']
+        total = sum(sizes.values())
+        for p, record in records:
+            if total <= self.max_bytes:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(p)
+            for b in record['files'].values():
+                refs[b['sha']] -= 1
+                if not refs[b['sha']]:
+                    total -= sizes[b['sha']]
+        # blobs are shared between records, only unreferenced ones are removed
+        kept = {sha for sha, n in refs.items() if n}
+        blob_root = path.join(self.root, 'blobs')
+        for dirpath, _, filenames in os.walk(blob_root):
+            for f in filenames:
+                p = path.join(dirpath, f)
+                # copies in progress and blobs of a writer not using the lock yet have no record
+                if f in kept or f.endswith('.tmp'):
+                    continue
+                with suppress(FileNotFoundError):
+                    if os.stat(p).st_mtime < started:
+                        os.remove(p)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,53 @@
+import threading
+from contextlib import contextmanager
+from time import time
+
+
+class Timer:
+    def __init__(self, precision: int = 3):
+        self.started = time()
+        # digits of seconds kept per span
+        self.precision = precision
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, name: str, duration: float, start: float = None, status='ok', **attrs):
+        if start is None:
+            start = time() - duration
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start": round(start - self.started, self.precision),
+                "duration": round(duration, self.precision),
+                "status": status,
+                **attrs,
+            })
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time()
+        status = 'ok'
+        try:
+            yield
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            self.add(name, time() - start, start=start, status=status, **attrs)
+
+    def phases(self) -> dict:
+        # total time per span name, spans of concurrent loads can overlap
+        result = {}
+        with self._lock:
+            for s in self.spans:
+                result[s['name']] = round(result.get(s['name'], 0) + s['duration'], self.precision)
+        return result
+
+    def summary(self) -> dict:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "total": round(time() - self.started, 3),
+            "phases": self.phases(),
+            "spans": spans,
+        }
@@ -0,0 +1,281 @@
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+from os import environ, path
+from time import sleep, time
+
+import requests
+import yaml
+
+from job import Job, KubeActionENV, get_action_cache, get_github_context, get_memo, load_secrets, wait_docker
+from timing import Timer
+
+
+class AssignmentENV(KubeActionENV):
+    # job of a leased assignment, everything else is read from the pool pod env
+    def __init__(self, assignment: dict):
+        self.assignment = assignment
+
+    @property
+    def flow_name(self):
+        return self.assignment.get('flow')
+
+    @property
+    def job_name(self):
+        return self.assignment['job_name']
+
+    @property
+    def job(self):
+        return self.assignment['job']
+
+    @property
+    def matrix(self):
+        return self.assignment.get('matrix') or {}
+
+    @property
+    def repository(self):
+        return self.assignment.get('repository')
+
+
+class HttpJobQueue:
+    # api-server /jobs, runs of EXECUTION_MODE=warm-pool
+    def __init__(self, api: str, worker: str, secrets: str = None, wait: float = 20):
+        self.api = api.rstrip('/')
+        self.worker = worker
+        self.secrets = secrets
+        # long poll, an idle worker gets a job as soon as it is queued
+        self.wait = wait
+
+    def lease(self):
+        res = requests.post(f'{self.api}/jobs/lease', json={
+            "worker": self.worker, "secrets": self.secrets, "wait": self.wait}, timeout=self.wait + 10)
+        if res.status_code == 204:
+            return None
+        res.raise_for_status()
+        return res.json()
+
+    def _accepted(self, res) -> bool:
+        # 409 is a lost lease, anything else but 200 is retried like a network error
+        if res.status_code != 409:
+            res.raise_for_status()
+        return res.status_code == 200
+
+    def heartbeat(self, task_id: str) -> bool:
+        res = requests.post(f'{self.api}/jobs/{task_id}/heartbeat', json={"worker": self.worker}, timeout=10)
+        return self._accepted(res)
+
+    def complete(self, task_id: str, succeeded: bool, timing: dict = None) -> bool:
+        res = requests.post(f'{self.api}/jobs/{task_id}/complete', json={
+            "worker": self.worker, "status": "succeeded" if succeeded else "failed", "timing": timing}, timeout=10)
+        return self._accepted(res)
+
+
+class LocalJobQueue:
+    # stand-in without a cluster: <root>/queued/<id>.json -> leased/<id>.json -> done/<id>.json
+    # rename is atomic, so several local workers can share a directory. leases never expire
+    def __init__(self, root: str, worker: str = 'local'):
+        self.root = root
+        self.worker = worker
+        for d in ('queued', 'leased', 'done'):
+            os.makedirs(path.join(root, d), exist_ok=True)
+
+    def _path(self, state: str, task_id: str) -> str:
+        return path.join(self.root, state, f'{task_id}.json')
+
+    def _write(self, p: str, data: dict):
+        tmp = f'{p}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, p)
+
+    def submit(self, job_name: str, job: dict, matrix: dict = None, flow: str = 'local', repository: str = '') -> str:
+        # queued in name order, needs are not tracked here
+        task_id = f'{time():.6f}-{job_name}'.replace('.', '-')
+        self._write(self._path('queued', task_id), {
+            "id": task_id, "flow": flow, "repository": repository, "job_name": job_name, "job": job,
+            "matrix": matrix or {}})
+        return task_id
+
+    def lease(self):
+        for name in sorted(os.listdir(path.join(self.root, 'queued'))):
+            if not name.endswith('.json'):
+                continue
+            leased = path.join(self.root, 'leased', name)
+            try:
+                os.rename(path.join(self.root, 'queued', name), leased)
+            except FileNotFoundError:
+                # taken by another worker
+                continue
+            with open(leased) as f:
+                return json.load(f)
+        return None
+
+    def heartbeat(self, task_id: str) -> bool:
+        return path.isfile(self._path('leased', task_id))
+
+    def complete(self, task_id: str, succeeded: bool, timing: dict = None) -> bool:
+        leased = self._path('leased', task_id)
+        if not path.isfile(leased):
+            return False
+        with open(leased) as f:
+            assignment = json.load(f)
+        self._write(self._path('done', task_id), {
+            **assignment, "worker": self.worker, "status": "succeeded" if succeeded else "failed", "timing": timing})
+        os.remove(leased)
+        return True
+
+
+def get_queue(target: str, worker: str, secrets: str = None):
+    if target.startswith('http://') or target.startswith('https://'):
+        return HttpJobQueue(target, worker, secrets=secrets)
+    return LocalJobQueue(target, worker)
+
+
+class Worker:
+    # warm runner: imports, docker readiness, secrets and caches are done once, then jobs are leased one by one
+    def __init__(self, queue, env: KubeActionENV = None, idle_sleep: float = 1, max_jobs: int = 0,
+                 complete_try: int = 5):
+        self.queue = queue
+        self.env = env or KubeActionENV()
+        self.idle_sleep = idle_sleep
+        # restart after max_jobs so state left by a job does not pile up, 0 is unlimited
+        self.max_jobs = max_jobs
+        self.done = 0
+        self.complete_try = complete_try
+        timer = Timer()
+        with timer.span('load_secrets'):
+            self.secrets = load_secrets()
+        if self.env.dind_mode:
+            wait_docker(timer)
+        self.action_cache = get_action_cache(self.env)
+        self.memo = get_memo(self.env)
+        print('worker ready', json.dumps(timer.summary()['phases']))
+
+    def _heartbeat(self, task_id: str, interval: float, stop: threading.Event, job: Job):
+        while not stop.wait(interval):
+            try:
+                if not self.queue.heartbeat(task_id):
+                    # the run was cancelled or the lease expired and the job is queued again, stop running it
+                    print(f'lease of {task_id} lost, stop the job')
+                    job.cancel()
+                    return
+            except requests.RequestException as e:
+                print(f'fail to renew lease of {task_id} {e}')
+
+    def _complete(self, task_id: str, succeeded: bool, summary: dict):
+        # the job already ran, retry so a network blip does not make it expire and run again
+        for i in range(self.complete_try):
+            try:
+                if not self.queue.complete(task_id, succeeded, summary):
+                    print(f"result of {task_id} was not accepted, the lease was lost")
+                return
+            except requests.RequestException as e:
+                print(f'fail to report {task_id} {e}')
+                sleep(min(2 ** i, 10))
+        print(f'give up reporting {task_id}, the lease expires and the job is queued again')
+
+    def run(self, assignment: dict) -> tuple:
+        timer = Timer()
+        env = AssignmentENV(assignment)
+        workspace = tempfile.TemporaryDirectory()
+        context = {
+            "github": get_github_context(env, workspace.name),
+            "matrix": env.matrix,
+        }
+        stop = threading.Event()
+        ttl = assignment.get('lease_ttl')
+        succeeded = False
+        try:
+            job = Job(env.job_name, env.job, workspace, ctx=context, secrets=self.secrets,
+                      action_cache=self.action_cache, load_concurrency=self.env.load_concurrency,
+                      overlap_load=self.env.overlap_load, image_pull_policy=self.env.image_pull_policy, timer=timer,
+                      github_url=self.env.github_url, memo=self.memo)
+            if ttl:
+                threading.Thread(target=self._heartbeat, args=(assignment['id'], ttl / 3, stop, job),
+                                 daemon=True).start()
+            job.load()
+            job.start()
+            succeeded = True
+        except Exception as e:
+            print(f"job {env.job_name} failed {e}")
+        finally:
+            workspace.cleanup()
+        summary = {
+            "flow": env.flow_name,
+            "job": env.job_name,
+            **timer.summary(),
+        }
+        print('kubeaction timing', json.dumps(summary))
+        try:
+            # the lease is kept renewed until the result is reported
+            self._complete(assignment['id'], succeeded, summary)
+        finally:
+            stop.set()
+        return succeeded, summary
+
+    def serve(self, once: bool = False):
+        while not self.max_jobs or self.done < self.max_jobs:
+            try:
+                assignment = self.queue.lease()
+            except requests.RequestException as e:
+                print(f'fail to lease a job {e}')
+                sleep(max(self.idle_sleep, 1))
+                continue
+            if not assignment:
+                if once:
+                    return
+                sleep(self.idle_sleep)
+                continue
+            print(f"leased {assignment['id']} {assignment['job_name']}")
+            self.run(assignment)
+            self.done += 1
+
+
+def serve(target: str, worker: str, secrets: str, once: bool, max_jobs: int):
+    queue = get_queue(target, worker, secrets)
+    Worker(queue, idle_sleep=0 if isinstance(queue, HttpJobQueue) else 1, max_jobs=max_jobs).serve(once=once)
+
+
+def submit_file(target: str, file: str):
+    with open(file) as f:
+        data = yaml.load(f, Loader=yaml.FullLoader)
+    queue = LocalJobQueue(target)
+    for job_name, job in data.get('jobs', {}).items():
+        if job.get('needs'):
+            print(f'{job_name} needs {job["needs"]}, the local queue runs it without waiting')
+        print('queued', queue.submit(job_name, job, flow=data.get('name', 'local')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='warm runner leasing jobs from a queue')
+    parser.add_argument('--queue', default=environ.get('KUBEACTION_QUEUE'),
+                        help='api-server url or a local queue directory')
+    parser.add_argument('--workers', type=int, default=int(environ.get('KUBEACTION_WORKERS', '1')),
+                        help='runner processes')
+    parser.add_argument('--secrets', default=environ.get('KUBEACTION_SECRETS'),
+                        help='name of the mounted secret, only runs using it are leased')
+    parser.add_argument('--max-jobs', type=int, default=int(environ.get('KUBEACTION_WORKER_MAX_JOBS', '0')),
+                        help='exit after this many jobs per process, 0 is unlimited')
+    parser.add_argument('--once', action='store_true', help='exit when the queue is empty')
+    parser.add_argument('--submit', help='queue the jobs of a workflow file into a local queue and exit')
+    args = parser.parse_args()
+    if not args.queue:
+        parser.error('--queue or KUBEACTION_QUEUE must be set')
+
+    if args.submit:
+        submit_file(args.queue, args.submit)
+    else:
+        name = environ.get('HOSTNAME', 'local')
+        if args.workers == 1:
+            serve(args.queue, name, args.secrets, args.once, args.max_jobs)
+        else:
+            procs = [multiprocessing.Process(target=serve, args=(args.queue, f'{name}-{i}', args.secrets, args.once,
+                                                                 args.max_jobs))
+                     for i in range(args.workers)]
+            for p in procs:
+                p.start()
+            for p in procs:
+                p.join()
@@ -1,18 +1,22 @@
 from os import path
 
 try:
-    from .workflow import LocalWorkFlow
+    from .workflow import LocalWorkFlow, ParallelLocalWorkFlow
 except Exception:
-    from workflow import LocalWorkFlow
+    from workflow import LocalWorkFlow, ParallelLocalWorkFlow
 
 if __name__ == '__main__':
+    import argparse
     from dotenv import load_dotenv
     import os
 
     load_dotenv(verbose=True)
     BASE_DIR = path.dirname(path.abspath(__file__))
-    file = path.join(BASE_DIR, 'simple.yaml')
-    file = path.join(BASE_DIR, 'uses-action.yaml')
+    parser = argparse.ArgumentParser(description='run a workflow file locally')
+    parser.add_argument('file', nargs='?', default=path.join(BASE_DIR, 'uses-action.yaml'))
+    parser.add_argument('--jobs', '-j', type=int, default=1, help='number of jobs to run at once')
+    args = parser.parse_args()
+    file = args.file
     context = {
         'github': {
             'author': 'wesky93@gamil.com'
@@ -21,5 +25,9 @@ if __name__ == '__main__':
     secrets = {
         "SLACK_WEBHOOK": os.environ.get('SLACK_WEBHOOK')
     }
-    wf = LocalWorkFlow(file, context, secrets)
-    wf.start()
+    if args.jobs > 1:
+        wf = ParallelLocalWorkFlow(file, context, secrets, max_jobs=args.jobs)
+        print(wf.start())
+    else:
+        wf = LocalWorkFlow(file, context, secrets)
+        wf.start()
@@ -1,11 +1,16 @@
 import os
+import sys
 import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from urllib.parse import urlparse
 
 import docker
 import git
 import yaml
-from jinja2 import Template
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'flow', 'src'))
+from executor import CommandOutput, run_command
+from expression import render_template
 
 
 def get_yaml_file(filename):
@@ -15,9 +20,7 @@ def get_yaml_file(filename):
 
 
 def template_render(_template: str, context: dict):
-    raw = _template.replace('${{', '{{')
-    temp = Template(raw)
-    return temp.render(**context)
+    return render_template(_template, context)
 
 
 def get_repo_name_version(p: str):
@@ -65,7 +68,8 @@ class RunStep(BaseStep):
         cmds = self.run.split('|')
         for cmd in cmds:
             cmd = cmd.replace('\n', '')
-            os.system(cmd)
+            # output goes through print, so it gets the job prefix in parallel mode
+            run_command(cmd, self.working_dir, dict(os.environ), CommandOutput(masks=list(self.secrets.values())))
 
     def load(self):
         pass
@@ -226,7 +230,14 @@ class BaseWorkFlow:
         self.context = context or {}
         self._wf = get_yaml_file(filename)
         self.secrets = secrets
-        self.jobs = get_jobs(self, self._wf)
+        self._jobs = None
+
+    @property
+    def jobs(self):
+        # built on first use, a parallel workflow builds its jobs inside the workers
+        if self._jobs is None:
+            self._jobs = get_jobs(self, self._wf)
+        return self._jobs
 
     def start(self):
         pass
@@ -242,3 +253,94 @@ class LocalWorkFlow(BaseWorkFlow):
         for job in self.jobs:
             job.load()
             job.start()
+
+
+def get_needs(job: dict) -> list:
+    needs = job.get('needs') or []
+    return [needs] if isinstance(needs, str) else list(needs)
+
+
+class PrefixWriter:
+    # prefix every complete line, partial lines are buffered so jobs do not interleave mid line
+    def __init__(self, stream, prefix: str):
+        self.stream = stream
+        self.prefix = prefix
+        self.buf = ''
+
+    def write(self, text: str):
+        self.buf += text
+        *lines, self.buf = self.buf.split('\n')
+        for line in lines:
+            self.stream.write(f'{self.prefix}{line}\n')
+        if lines:
+            self.stream.flush()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class JobWorkFlow:
+    # the part of a workflow a job needs inside a pool worker
+    def __init__(self, context: dict, secrets: dict):
+        self.context = context
+        self.secrets = secrets
+
+
+def run_job(name: str, data: dict, context: dict, secrets: dict, prefix: str):
+    sys.stdout = PrefixWriter(sys.stdout, prefix)
+    try:
+        # a separate workspace per job
+        job = Job(name=name, data=data, workflow=JobWorkFlow(context, secrets))
+        job.load()
+        job.start()
+    finally:
+        if sys.stdout.buf:
+            sys.stdout.write('\n')
+        sys.stdout = sys.stdout.stream
+
+
+class ParallelLocalWorkFlow(LocalWorkFlow):
+    # jobs run in a process pool as soon as the jobs they need succeeded
+    def __init__(self, filename: str, context: dict = None, secrets: dict = {}, max_jobs: int = None):
+        super().__init__(filename, context, secrets)
+        self.max_jobs = max_jobs or os.cpu_count()
+        self.results = {}
+
+    def start(self):
+        jobs = self._wf.get('jobs', {})
+        needs = {name: get_needs(job) for name, job in jobs.items()}
+        for name, deps in needs.items():
+            unknown = [d for d in deps if d not in jobs]
+            if unknown:
+                raise ValueError(f'job {name} needs unknown jobs {unknown}')
+        width = max(len(name) for name in jobs) if jobs else 0
+        pending = dict(needs)
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.max_jobs) as pool:
+            while pending or running:
+                for name, deps in list(pending.items()):
+                    if any(self.results.get(d) in ('failure', 'skipped') for d in deps):
+                        # like github, jobs after a failed job do not run
+                        print(f'skip {name}, needed job failed')
+                        self.results[name] = 'skipped'
+                        del pending[name]
+                    elif all(self.results.get(d) == 'success' for d in deps):
+                        fut = pool.submit(run_job, name, jobs[name], self.context, self.secrets,
+                                          f'[{name:<{width}}] ')
+                        running[fut] = name
+                        del pending[name]
+                if not running:
+                    if pending:
+                        raise ValueError(f'jobs {list(pending)} have a needs cycle')
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    name = running.pop(fut)
+                    try:
+                        fut.result()
+                        self.results[name] = 'success'
+                    except Exception as e:
+                        print(f'job {name} failed: {e}')
+                        self.results[name] = 'failure'
+        return self.results